@@ -0,0 +1,111 @@
+import logging
+
+# Class confirms that files with equal content hash are byte for byte identical. All files of
+# a group are read in lockstep chunks and the group is split as soon as chunks differ, so
+# files that differ early are not read any further.
+
+
+class Compare:
+    # Maximum number of files kept open at once.
+    MAX_OPEN_FILES = 64
+
+    # Bytes read from every file per step.
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, maxOpenFiles=MAX_OPEN_FILES, chunkSize=CHUNK_SIZE):
+        # Create logger
+        self.clog = logging.getLogger("CORE.COMPARE")
+
+        # A group larger than this is compared against one reference file at a time.
+        self.maxOpenFiles = max(2, maxOpenFiles)
+        self.chunkSize = chunkSize
+
+    def splitGroup(self, paths):
+        """
+        Splits files into classes of identical content.
+        :return: List of classes, every class is a list of paths. Classes with single file are included.
+        """
+        classes = []
+        remaining = list(paths)
+        while len(remaining) > self.maxOpenFiles:
+            # Too many files to open at once, collect files equal to first file in batches.
+            reference = remaining[0]
+            same = [reference]
+            different = []
+            batchSize = self.maxOpenFiles - 1
+            for i in range(1, len(remaining), batchSize):
+                batch = remaining[i:i + batchSize]
+                for fileClass in self.compareAll([reference] + batch):
+                    if fileClass[0] == reference:
+                        same.extend(fileClass[1:])
+                    else:
+                        different.extend(fileClass)
+
+            classes.append(same)
+            remaining = different
+
+        if remaining:
+            classes.extend(self.compareAll(remaining))
+
+        return classes
+
+    def compareAll(self, paths):
+        """
+        Compares all files in lockstep, number of paths must not exceed maxOpenFiles.
+        :return: List of classes of identical files, first class contains first path.
+        """
+        files = {}
+        classes = []
+        try:
+            groups = [[]]
+            for path in paths:
+                try:
+                    files[path] = open(path, "rb")
+                    groups[0].append(path)
+                except OSError as ex:
+                    # Unreadable file can not be confirmed as duplicate.
+                    self.clog.warning("Could not open %s for compare: %s", path, ex)
+                    classes.append([path])
+
+            while groups:
+                nextGroups = []
+                for group in groups:
+                    if len(group) == 1:
+                        classes.append(group)
+                        self.closeFiles(files, group)
+                        continue
+
+                    # Bucket files of the group by their next chunk.
+                    buckets = {}
+                    for path in group:
+                        try:
+                            chunk = files[path].read(self.chunkSize)
+                        except OSError as ex:
+                            self.clog.warning("Could not read %s for compare: %s", path, ex)
+                            classes.append([path])
+                            self.closeFiles(files, [path])
+                            continue
+                        buckets.setdefault(chunk, []).append(path)
+
+                    for chunk, bucket in buckets.items():
+                        if chunk == b"" or len(bucket) == 1:
+                            # All files reached end together or file differs from rest.
+                            classes.append(bucket)
+                            self.closeFiles(files, bucket)
+                        else:
+                            nextGroups.append(bucket)
+
+                groups = nextGroups
+        finally:
+            self.closeFiles(files, list(files))
+
+        # Classes keep input order of their files, order classes by their first file.
+        order = {path: i for i, path in enumerate(paths)}
+        classes.sort(key=lambda fileClass: order[fileClass[0]])
+        return classes
+
+    def closeFiles(self, files, paths):
+        for path in paths:
+            f = files.pop(path, None)
+            if f is not None:
+                f.close()
@@ -1,6 +1,9 @@
 # Required for logging across app
 import logging
 
+# Command line options
+import argparse
+
 # To get information about any exception
 import traceback
 
@@ -12,8 +15,22 @@ import time
 from core.sqlite_db import DB
 
 # Import internal package.
+from core.scan import Scan
+from core.daemon import Daemon
 from core.main_menu import MainMenu
 
+# Read command line options, without --daemon the interactive main menu is shown.
+parser = argparse.ArgumentParser(description="Core server of findup.")
+parser.add_argument("--daemon", action="store_true",
+                    help="Process pending scans unattended till SIGTERM or SIGINT, SIGHUP checks for new scans at once.")
+parser.add_argument("--poll-interval", type=float, default=Daemon.POLL_INTERVAL,
+                    help="Seconds between checks for new scans in daemon mode.")
+parser.add_argument("--walker-workers", type=int, default=1,
+                    help="Number of threads used to list directories.")
+parser.add_argument("--hash-workers", type=int, default=1,
+                    help="Number of threads used to compute file hashes per device.")
+args = parser.parse_args()
+
 
 # Create a new logger for core application
 log = logging.getLogger("CORE")
@@ -47,18 +64,26 @@ log.info("Created database object")
 db.createDbs()
 log.info("Created required database tables")
 
-# Create main menu object
-mainMenu = MainMenu()
-log.info("Created main menu object")
+# Create scan object, it is kept with its database connection for life of the server.
+scan = Scan(walkerWorkers=args.walker_workers, hashWorkers=args.hash_workers)
+log.info("Created scan object")
 
 try:
-    # display menu main and it will continue till exit is pressed.
-    log.critical("Core server display main menu")
-    mainMenu.display()
+    if args.daemon:
+        # Process scans as they are added, till a stop signal is received.
+        daemon = Daemon(scan, args.poll_interval)
+        daemon.installSignalHandlers()
+        log.critical("Core server running as daemon")
+        daemon.run()
+    else:
+        # display menu main and it will continue till exit is pressed.
+        mainMenu = MainMenu(scan)
+        log.critical("Core server display main menu")
+        mainMenu.display()
 
 # Accept Ctrl+c and Ctrl+x commands to exit the core server.
 except (KeyboardInterrupt, SystemExit):
-    log.warning("Received ctrl+c / ctrl+x commands to quit the core server")
+    log.warning("Received ctrl+c / ctrl+x commands or second stop signal to quit the core server")
 
 # All other exceptions should not kill the server.
 except Exception as ex:
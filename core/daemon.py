@@ -0,0 +1,76 @@
+import signal
+import logging
+import threading
+
+# Class to run the core server unattended, it processes pending scans as they are added
+# and keeps one scan object, with its database connection and caches, for its whole life.
+
+
+class Daemon:
+    # Seconds between checks for new scans, SIGHUP checks at once.
+    POLL_INTERVAL = 5.0
+
+    def __init__(self, scan, pollInterval=POLL_INTERVAL):
+        """
+        :param scan: Scan object that processes every pending scan, reused across scans.
+        :param pollInterval: Seconds to wait for new scans when nothing is pending.
+        """
+        # Create logger
+        self.clog = logging.getLogger("CORE.DAEMON")
+
+        self.scan = scan
+        self.pollInterval = pollInterval
+
+        # Set to end the wait for new scans before poll interval is over.
+        self.wakeEvent = threading.Event()
+
+    def installSignalHandlers(self):
+        """
+        SIGTERM and SIGINT stop the daemon after the files in flight of a scan, a second one exits at once.
+        SIGHUP tells the daemon that a new scan was added.
+        """
+        signal.signal(signal.SIGTERM, self.handleStopSignal)
+        signal.signal(signal.SIGINT, self.handleStopSignal)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.handleWakeSignal)
+
+    def handleStopSignal(self, signum, frame):
+        if self.scan.stopEvent.is_set():
+            # Interrupted state is repeated by the next start.
+            raise SystemExit("Received signal {signum} again, exiting without waiting for the running scan".format(
+                signum=signum))
+
+        self.clog.warning(
+            "Received signal %d, stopping after the files in flight of the running scan", signum)
+        self.stop()
+
+    def handleWakeSignal(self, signum, frame):
+        self.wakeEvent.set()
+
+    def stop(self):
+        self.scan.requestStop()
+        self.wakeEvent.set()
+
+    def run(self):
+        """
+        Processes pending scans till stop() is called. A failing scan is backed off by Scan.process(), any
+        other exception fails only the current pass and pending scans are tried again after poll interval.
+        """
+        self.clog.critical(
+            "Core server daemon started, checking for pending scans every %.1fs", self.pollInterval)
+
+        while not self.scan.stopEvent.is_set():
+            # 1. Clear the wake up first, so a scan added while processing is picked up by the next pass.
+            self.wakeEvent.clear()
+
+            # 2. Process all pending scans, including scans interrupted by the last stop.
+            try:
+                self.scan.process()
+            except Exception:
+                self.clog.exception("An exception occurred while processing pending scans")
+                self.scan.db.rollback()
+
+            # 3. Wait for new scans.
+            self.wakeEvent.wait(self.pollInterval)
+
+        self.clog.critical("Core server daemon stopped")
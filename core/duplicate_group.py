@@ -0,0 +1,164 @@
+import logging
+from core.fsobject import FsObject
+
+# Class builds the duplicate group report of a scan. When two folders are identical every
+# object below them is a duplicate too, so only topmost duplicates are reported. A group whose
+# members all sit inside copies of the same duplicate folder is collapsed into the group of
+# that folder, any other group is kept with members of only one copy of every duplicate folder.
+
+
+class DuplicateGroup:
+    # Objects in these states take part in duplicate groups.
+    DUPLICATE_STATES = (FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                        FsObject.FSOBJECT_STATE_DUPLICATE_BY_SUBITEM,
+                        FsObject.FSOBJECT_STATE_DUPLICATE_BY_CONTENT)
+
+    # Number of member rows written per executemany.
+    INSERT_BATCH_SIZE = 50000
+
+    def __init__(self, db, insertBatchSize=INSERT_BATCH_SIZE):
+        # Create logger
+        self.clog = logging.getLogger("CORE.DUPLICATE_GROUP")
+
+        # DB object
+        self.db = db
+
+        self.insertBatchSize = insertBatchSize
+
+    def build(self, scanId, folderPrefixes):
+        """
+        Replaces duplicate groups of the scan with topmost duplicate groups. Every group is written with
+        its wasted bytes and the shortest member path as representative, so the report needs no grouping.
+        Bytes of an object are counted once, in the group of its topmost duplicate.
+        :param folderPrefixes: Folder id to full path map of the scan, see FsObject.getFolderPrefixes().
+        :return: Number of groups written.
+        """
+        self.deleteAllForScanId(scanId)
+
+        # 1. Group duplicate objects by type, hash and size, folder and file hashes never mix.
+        groups = {}
+        query = "SELECT id, parent_id, type, content_hash, size_in_bytes, state, name FROM fsobject WHERE scan_id = ? AND state IN (?, ?, ?)"
+        rows = self.db.fetchAll(query, (scanId, ) + self.DUPLICATE_STATES)
+        folderHashes = {row[0]: row[3] for row in rows
+                        if row[5] == FsObject.FSOBJECT_STATE_DUPLICATE_BY_SUBITEM}
+        folderCounts = {}
+        for folderHash in folderHashes.values():
+            folderCounts[folderHash] = folderCounts.get(folderHash, 0) + 1
+
+        for objectId, parentId, objectType, contentHash, sizeInBytes, _, name in rows:
+            parentHash = folderHashes.get(parentId)
+            group = groups.get((objectType, contentHash, sizeInBytes))
+            if group is None:
+                group = groups[(objectType, contentHash, sizeInBytes)] = [
+                    sizeInBytes, [], parentHash, parentHash is None]
+
+            # 1.a Root folder keeps its full path as name.
+            path = folderPrefixes[parentId] + name if parentId else name
+            group[1].append((objectId, parentId, parentHash, path))
+
+            # 2. Group is implied by its parents only when all members are inside copies of the same
+            # duplicate folder, member outside of such folders makes the group topmost.
+            if parentHash is None or parentHash != group[2]:
+                group[3] = True
+
+        # 2.a Same content more than once within every copy of a folder is a duplicate on its own.
+        for group in groups.values():
+            if not group[3] and len(group[1]) != folderCounts[group[2]]:
+                group[3] = True
+
+        # 3. Write topmost groups with pre-assigned ids so members can be written in batches.
+        row = self.db.fetchAll("SELECT MAX(id) FROM dup_group", None)
+        nextId = (row[0][0] or 0) + 1
+        groupRows = []
+        memberRows = []
+        for (objectType, contentHash, _), (sizeInBytes, members, _, topmost) in groups.items():
+            if not topmost:
+                continue
+
+            # 3.a Members in other copies of a duplicate folder are counted by group of that folder, shortest path
+            # is the representative.
+            members = self.collapseCopies(members, folderPrefixes)
+            if len(members) < 2:
+                continue
+
+            representativePath = min((len(member[3]), member[3]) for member in members)[1]
+            groupRows.append((nextId, scanId, contentHash, objectType, sizeInBytes, len(members),
+                              sizeInBytes * (len(members) - 1), representativePath))
+            memberRows.extend((nextId, member[0]) for member in members)
+            nextId += 1
+
+            if len(memberRows) >= self.insertBatchSize:
+                self.flush(groupRows, memberRows)
+                groupRows, memberRows = [], []
+
+        self.flush(groupRows, memberRows)
+        self.db.commit()
+
+        total = self.db.fetchAll(
+            "SELECT COUNT(*) FROM dup_group WHERE scan_id = ?", (scanId, ))[0][0]
+        self.clog.critical(
+            "Scan id: %ld, Reported %d topmost duplicate groups out of %d", scanId, total, len(groups))
+        return total
+
+    def collapseCopies(self, members, folderPrefixes):
+        """
+        Keeps members that are not inside a duplicate folder and members inside one copy of every duplicate folder,
+        the copy with the shortest path.
+        :param members: List of tuple (id, parent id, parent folder hash, path), hash is None outside duplicate folders.
+        :return: Kept members.
+        """
+        keptParents = {}
+        for _, parentId, parentHash, _ in members:
+            if parentHash is None:
+                continue
+            kept = keptParents.get(parentHash)
+            path = folderPrefixes[parentId]
+            if kept is None or (len(path), path) < (len(folderPrefixes[kept]), folderPrefixes[kept]):
+                keptParents[parentHash] = parentId
+
+        return [member for member in members if member[2] is None or keptParents[member[2]] == member[1]]
+
+    def flush(self, groupRows, memberRows):
+        if groupRows:
+            query = "INSERT INTO dup_group(id, scan_id, content_hash, type, size_in_bytes, member_count, wasted_bytes, representative_path) " \
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            self.db.execMany(query, groupRows, False)
+        if memberRows:
+            query = "INSERT INTO dup_group_member(group_id, fsobject_id) VALUES (?, ?)"
+            self.db.execMany(query, memberRows, False)
+
+    def getGroups(self, scanId, limit, after=None):
+        """
+        Returns one page of groups with most wasted bytes first. Pages are addressed by the last group of
+        previous page instead of an offset, so every page is a range read of dup_group_scan_wasted index.
+        :param after: Tuple (wasted_bytes, id) of last group of previous page, None for first page.
+        :return: List of tuple (id, content_hash, type, size_in_bytes, member_count, wasted_bytes, representative_path).
+        """
+        columns = "id, content_hash, type, size_in_bytes, member_count, wasted_bytes, representative_path"
+        if after is None:
+            query = "SELECT {columns} FROM dup_group WHERE scan_id = ? ORDER BY wasted_bytes DESC, id DESC LIMIT ?".format(
+                columns=columns)
+            return self.db.fetchAll(query, (scanId, limit))
+
+        query = "SELECT {columns} FROM dup_group WHERE scan_id = ? AND (wasted_bytes, id) < (?, ?) " \
+            "ORDER BY wasted_bytes DESC, id DESC LIMIT ?".format(columns=columns)
+        return self.db.fetchAll(query, (scanId, after[0], after[1], limit))
+
+    def getMembers(self, groupId):
+        """
+        :return: List of tuple (fsobject id, full path) of the group.
+        """
+        # Full path is built by walking up from every member to the root, root name is the root path.
+        query = "WITH RECURSIVE up(member_id, parent_id, path) AS (" \
+            "SELECT f.id, f.parent_id, f.name FROM dup_group_member m JOIN fsobject f ON f.id = m.fsobject_id WHERE m.group_id = ? " \
+            "UNION ALL " \
+            "SELECT up.member_id, p.parent_id, CASE WHEN substr(p.name, -1) = '/' THEN p.name || up.path ELSE p.name || '/' || up.path END " \
+            "FROM up JOIN fsobject p ON p.id = up.parent_id" \
+            ") SELECT member_id, path FROM up WHERE parent_id = 0 ORDER BY path"
+        return self.db.fetchAll(query, (groupId, ))
+
+    def deleteAllForScanId(self, scanId):
+        query = "DELETE FROM dup_group_member WHERE group_id IN (SELECT id FROM dup_group WHERE scan_id = ?)"
+        self.db.execDelete(query, (scanId, ), False)
+        self.db.execDelete(
+            "DELETE FROM dup_group WHERE scan_id = ?", (scanId, ), True)
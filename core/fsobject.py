@@ -1,9 +1,13 @@
 import os
 import time
+import array
 import logging
-from core.utility import Utility
+import threading
 from core.sqlite_db import DB
 from core.hash import Hash
+from core.hash_cache import HashCache
+from core.hash_engine import HashEngine
+from core.compare import Compare
 
 # Class object stores and retrieves file system objects i.e., files and directories
 
@@ -21,14 +25,46 @@ class FsObject:
     FSOBJECT_STATE_UNIQUE_BY_SIZE = 5
     FSOBJECT_STATE_UNIQUE_BY_HASH = 6
     FSOBJECT_STATE_UNIQUE_BY_SUBITEM = 7
+    FSOBJECT_STATE_PARTIAL_HASH_COMPUTED = 8
+    FSOBJECT_STATE_UNIQUE_BY_PARTIAL_HASH = 9
+    FSOBJECT_STATE_FAST_HASH_COLLISION = 10
+    FSOBJECT_STATE_CONFIRM_HASH_COMPUTED = 11
+    FSOBJECT_STATE_DUPLICATE_BY_CONTENT = 12
+    FSOBJECT_STATE_UNIQUE_BY_CONTENT = 13
+    FSOBJECT_STATE_UNREADABLE = 14
 
-    def __init__(self, db):
+    # Bytes read from start and from end of a file for its partial hash.
+    PARTIAL_HASH_SAMPLE_BYTES = 64 * 1024
+
+    # Number of hash updates written per executemany.
+    UPDATE_BATCH_SIZE = 10000
+
+    # Maximum folders kept in the in-memory path to id map during insertion, beyond this
+    # parent ids are looked up from database one path component at a time.
+    MAX_CACHED_FOLDERS = 1000000
+
+    # Number of rows buffered and written with one executemany and one commit.
+    INSERT_BATCH_SIZE = 50000
+
+    INSERT_QUERY = "INSERT INTO fsobject(id, scan_id, parent_id, type, name, state, size_in_bytes, content_hash, created_timestamp, modified_timestamp, mtime_ns, inode, device, partial_hash) " \
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+    # Sets content hash and state of a file, bound as (hash, hash, prefix, state, id). Hash of the scan algorithm that a
+    # confirm or class hash replaces is kept in algorithm_hash, incremental scans copy only hashes of their algorithm.
+    HASH_UPDATE_QUERY = "UPDATE fsobject SET algorithm_hash = COALESCE(algorithm_hash, NULLIF(content_hash, ?)), content_hash = ?, hash_prefix = ?, state = ? WHERE id = ?"
+
+    # Files of a scan in a given state, path is built from the folder path map.
+    FILE_QUERY = "SELECT id, parent_id, name, device, inode, size_in_bytes, mtime_ns FROM fsobject WHERE scan_id = ? AND type = ? AND state = ?"
+
+    def __init__(self, db, maxCachedFolders=MAX_CACHED_FOLDERS, insertBatchSize=INSERT_BATCH_SIZE, partialHashSampleBytes=PARTIAL_HASH_SAMPLE_BYTES, hashWorkers=1, hashDeviceWorkers=None,
+                 hashBlockSize=Hash.BLOCK_SIZE, hashMmapThreshold=Hash.MMAP_THRESHOLD, stopEvent=None):
+        """
+        :param stopEvent: Optional threading.Event, once it is set hashing and verify stages return early. States of
+        files are written as they are computed, so the stage continues where it stopped when it runs again.
+        """
         # Create logger
         self.clog = logging.getLogger("CORE.FSOBJECT")
 
-        # Create utlity object
-        self.utility = Utility()
-
         # DB object
         self.db = db
 
@@ -39,168 +75,636 @@ class FsObject:
         self.currParentFullPath = ""
         self.currParentId = -1
 
-    def setScanId(self, scanId):
+        # Folder full path to id map of folders inserted but not yet used as parent.
+        self.folderIds = {}
+        self.maxCachedFolders = maxCachedFolders
+        self.folderIdsOverflow = False
+
+        # Root folder of the scan, its name is the full root path.
+        self.rootPath = None
+        self.rootId = -1
+
+        # Folder id to full path map, built once per scan when paths are needed.
+        self.folderPrefixes = None
+
+        # Size of head and tail sample used for partial hash.
+        self.partialHashSampleBytes = partialHashSampleBytes
+
+        # File hashing, shared by all stages and hash engine threads. Algorithm is set per scan.
+        self.hash = Hash(hashBlockSize, hashMmapThreshold)
+
+        # Strong hash used to confirm collisions of a non-cryptographic scan algorithm.
+        self.confirmHash = Hash(hashBlockSize, hashMmapThreshold, Hash.CONFIRM_ALGORITHM)
+        self.confirmCollisions = False
+
+        # Stop request of the scan.
+        self.stopEvent = stopEvent or threading.Event()
+
+        # Engine computing hashes on worker threads, this object stays the only db writer.
+        # Files are queued per device, see HashEngine for per device tuning.
+        self.hashEngine = HashEngine(
+            hashWorkers, deviceWorkers=hashDeviceWorkers, stopEvent=self.stopEvent)
+
+        # Content hash cache shared across scans.
+        self.hashCache = HashCache(db)
+
+        # Byte by byte comparison of duplicate candidates.
+        self.compare = Compare()
+
+        # Rows waiting to be written, ids are assigned here so children can refer to
+        # a parent that is not written yet.
+        self.insertBatchSize = max(1, insertBatchSize)
+        self.pendingRows = []
+        self.nextId = -1
+        self.insertedRows = 0
+        self.insertSeconds = 0.0
+
+    def setScanId(self, scanId, hashAlgorithm=Hash.DEFAULT_ALGORITHM, confirmHash=False):
+        """
+        :param hashAlgorithm: Algorithm used for partial and content hash of this scan.
+        :param confirmHash: If True and algorithm is not cryptographic, duplicates are confirmed with Hash.CONFIRM_ALGORITHM.
+        """
         self.scanId = scanId
+        self.hash.setAlgorithm(hashAlgorithm)
+        self.confirmCollisions = bool(
+            confirmHash) and not self.hash.isCryptographic()
+
+        # Folder ids belong to a scan, start with an empty map.
+        self.folderIds = {}
+        self.folderIdsOverflow = False
+        self.currParentFullPath = ""
+        self.currParentId = -1
+        self.rootPath = None
+        self.rootId = -1
+        self.folderPrefixes = None
+
+        # Reset insert pipeline.
+        self.pendingRows = []
+        self.nextId = -1
+        self.insertedRows = 0
+        self.insertSeconds = 0.0
+        self.hashCache.resetStatistics()
+
+    def getParentId(self, parentFullPath):
+        """
+        Returns id of already inserted parent folder. Walk is top-down and all children of a folder
+        are inserted together, so a folder is removed from the map once it is used as parent.
+        """
+        parentId = self.folderIds.pop(parentFullPath, None)
+        if parentId is not None:
+            return parentId
+
+        # Fallback for folders that did not fit in the map, parent may still be buffered. Path
+        # is resolved from root one name at a time.
+        self.flushInserts()
+        if not parentFullPath.startswith(self.rootPath):
+            return None
 
-    def insert(self, fsobjectType, parentFullPath, objectName, sizeInBytes, commitImmediately):
-        objectName = self.utility.encodeDBString(objectName)
+        parentId = self.rootId
+        query = "SELECT id FROM fsobject WHERE scan_id = ? AND parent_id = ? AND name = ? AND type = ?"
+        for name in parentFullPath[len(self.rootPath):].split(os.sep):
+            if not name:
+                continue
 
+            row = self.db.fetchAll(
+                query, (self.scanId, parentId, name, self.FSOBJECT_TYPE_FOLDER))
+            if not row:
+                return None
+            parentId = row[0][0]
+
+        return parentId
+
+    def cacheFolderId(self, fullPath, folderId):
+        if len(self.folderIds) < self.maxCachedFolders:
+            self.folderIds[fullPath] = folderId
+            return
+
+        if not self.folderIdsOverflow:
+            # Map is full, from now on lookups go to database so make them indexed.
+            self.clog.warning(
+                "Folder id map is full (%d folders), falling back to database lookups", self.maxCachedFolders)
+            self.db.createFsobjectIndexes(["fsobject_scan_parent_name"])
+            self.folderIdsOverflow = True
+
+    def allocateId(self):
+        if self.nextId < 0:
+            # Continue after highest id ever used, same as AUTOINCREMENT would do.
+            row = self.db.fetchAll(
+                "SELECT MAX(IFNULL((SELECT seq FROM sqlite_sequence WHERE name = 'fsobject'), 0), IFNULL((SELECT MAX(id) FROM fsobject), 0))", None)
+            self.nextId = row[0][0] + 1
+
+        objectId = self.nextId
+        self.nextId += 1
+        return objectId
+
+    def insert(self, fsobjectType, parentFullPath, objectName, sizeInBytes, mtimeNs, inode, device):
+        """
+        Buffers a file system object for insertion, stat fields are the ones reported by the walker.
+        Rows are written in batches, caller must call flushInserts() once done.
+        :return: Id assigned to the object.
+        """
         timestamp = int(round(time.time() * 1000))
-        fullPath = None
         if parentFullPath is None:
-            fullPath = objectName
+            # Root folder keeps its full path as name.
             self.currParentFullPath = ""
             self.currParentId = 0
-        else:
-            parentFullPath = self.utility.encodeDBString(parentFullPath)
-            fullPath = os.path.join(parentFullPath, objectName)
-            if self.currParentFullPath != parentFullPath:
-                query = "SELECT id FROM fsobject WHERE scan_id = {id} AND type = {type} AND full_path = '{path}' LIMIT 0,1".format(
-                    id=self.scanId, type=self.FSOBJECT_TYPE_FOLDER, path=parentFullPath)
-                row = self.db.fetchAll(query, None)
-                if not row:
-                    raise Exception("Could not find parent of an object: {objectName} for parent full path: {parentFullPath}".format(
-                        objectName=objectName, parentFullPath=parentFullPath))
-                    #raise Exception("Invalid parent path")
-                self.currParentId = row[0][0]
-                self.currParentFullPath = parentFullPath
-
-        query = "INSERT INTO fsobject(scan_id, parent_id, type, full_path, state, size_in_bytes, content_hash, created_timestamp, modified_timestamp) " \
-            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
-        data = (self.scanId, self.currParentId, fsobjectType, fullPath,
-                self.FSOBJECT_STATE_PENDING, sizeInBytes, "", timestamp, timestamp)
-        self.db.execInsert(query, data, commitImmediately)
-
-    def commitTransactions(self):
-        self.db.commit()
+        elif self.currParentFullPath != parentFullPath:
+            parentId = self.getParentId(parentFullPath)
+            if parentId is None:
+                raise Exception("Could not find parent of an object: {objectName} for parent full path: {parentFullPath}".format(
+                    objectName=objectName, parentFullPath=parentFullPath))
+            self.currParentId = parentId
+            self.currParentFullPath = parentFullPath
+
+        objectId = self.allocateId()
+        self.pendingRows.append((objectId, self.scanId, self.currParentId, fsobjectType, objectName,
+                                 self.FSOBJECT_STATE_PENDING, sizeInBytes, None, timestamp, timestamp, mtimeNs, inode, device, None))
+        if len(self.pendingRows) >= self.insertBatchSize:
+            self.flushInserts()
+
+        # Only folders need full path, to find them again as parent.
+        if fsobjectType == self.FSOBJECT_TYPE_FOLDER:
+            if parentFullPath is None:
+                self.rootPath = objectName
+                self.rootId = objectId
+                self.cacheFolderId(objectName, objectId)
+            else:
+                self.cacheFolderId(os.path.join(
+                    parentFullPath, objectName), objectId)
+
+        return objectId
+
+    def flushInserts(self):
+        """
+        Writes all buffered rows with a single executemany in one transaction.
+        """
+        if not self.pendingRows:
+            return
+
+        start = time.perf_counter()
+        self.db.execMany(self.INSERT_QUERY, self.pendingRows, True)
+        self.insertSeconds += time.perf_counter() - start
+        self.insertedRows += len(self.pendingRows)
+        self.pendingRows = []
+
+    def getInsertRate(self):
+        """
+        :return: Rows per second spent in database writes since scan id was set.
+        """
+        if self.insertSeconds == 0:
+            return 0
+
+        return self.insertedRows / self.insertSeconds
+
+    def getFolderPrefixes(self):
+        """
+        Builds full path of every folder of the scan from names, parent is always inserted before its
+        children so one pass in id order is enough. Paths end with separator so a child path is a plain
+        concatenation. Map is built once per scan.
+        :return: Dictionary of folder id to full path ending with separator.
+        """
+        if self.folderPrefixes is None:
+            folderPrefixes = {}
+            query = "SELECT id, parent_id, name FROM fsobject WHERE scan_id = ? AND type = ? ORDER BY id"
+            for folderId, parentId, name in self.db.fetchAll(query, (self.scanId, self.FSOBJECT_TYPE_FOLDER)):
+                path = name if parentId == 0 else folderPrefixes[parentId] + name
+                folderPrefixes[folderId] = path if path.endswith(
+                    os.sep) else path + os.sep
+            self.folderPrefixes = folderPrefixes
+
+        return self.folderPrefixes
+
+    def getFiles(self, state):
+        """
+        :return: List of tuple (id, full path, device, inode, size_in_bytes, mtime_ns) of files in given state.
+        """
+        folderPrefixes = self.getFolderPrefixes()
+        rows = self.db.fetchAll(
+            self.FILE_QUERY, (self.scanId, self.FSOBJECT_TYPE_FILE, state))
+        return [(row[0], folderPrefixes[row[1]] + row[2]) + row[3:] for row in rows]
+
+    def copyHashesFromScan(self, baseScanId):
+        """
+        Copies content and partial hash from given scan into pending files of current scan, a file
+        is unchanged when its path, size, mtime and inode are same in both scans. Paths are compared
+        by pairing folders of both scans by name from the root down.
+        markDuplicateFiles does not read a file again for a hash it already has.
+        :return: Number of files whose hashes are reused.
+        """
+        # Objects of both scans are matched by parent and name, previous scan may be in its own file.
+        self.db.createFsobjectIndexes(["fsobject_scan_parent_name"])
+        base = self.db.attachScan(baseScanId)
+
+        # 1. Pair every folder of current scan with folder at same path in previous scan. Folders are looked up
+        # by parent, without statistics the planner would read all folders of the scan by type instead.
+        self.db.execInsert(
+            "CREATE TEMP TABLE IF NOT EXISTS folder_pair(id INTEGER PRIMARY KEY, base_id INTEGER)", None, False)
+        self.db.execDelete("DELETE FROM temp.folder_pair", None, False)
+        query = "INSERT INTO temp.folder_pair(id, base_id) WITH RECURSIVE pair(id, base_id) AS (" \
+            "SELECT c.id, b.id FROM fsobject c INDEXED BY fsobject_scan_parent_name JOIN \"{base}\".fsobject b INDEXED BY fsobject_scan_parent_name ON b.scan_id = ? AND b.parent_id = 0 AND b.name = c.name AND b.type = c.type " \
+            "WHERE c.scan_id = ? AND c.parent_id = 0 AND c.type = ? " \
+            "UNION ALL " \
+            "SELECT c.id, b.id FROM pair p JOIN fsobject c INDEXED BY fsobject_scan_parent_name ON c.scan_id = ? AND c.parent_id = p.id AND c.type = ? " \
+            "JOIN \"{base}\".fsobject b INDEXED BY fsobject_scan_parent_name ON b.scan_id = ? AND b.parent_id = p.base_id AND b.name = c.name AND b.type = c.type" \
+            ") SELECT id, base_id FROM pair".format(base=base)
+        self.db.execInsert(query, (baseScanId, self.scanId, self.FSOBJECT_TYPE_FOLDER,
+                                   self.scanId, self.FSOBJECT_TYPE_FOLDER, baseScanId), False)
+
+        # 2. Copy hashes of unchanged files inside paired folders, a replaced content hash is copied as hash of the scan
+        # algorithm it replaced. Empty algorithm hash marks a replaced hash that is not known, see DB.addAlgorithmHashColumn().
+        query = "UPDATE fsobject SET content_hash = NULLIF(COALESCE(b.algorithm_hash, b.content_hash), X''), " \
+            "hash_prefix = hash_to_prefix(NULLIF(COALESCE(b.algorithm_hash, b.content_hash), X'')), partial_hash = b.partial_hash " \
+            "FROM temp.folder_pair p JOIN \"{base}\".fsobject b INDEXED BY fsobject_scan_parent_name ON b.scan_id = ? AND b.parent_id = p.base_id " \
+            "WHERE fsobject.scan_id = ? AND fsobject.parent_id = p.id AND fsobject.type = ? AND fsobject.state = ? " \
+            "AND b.name = fsobject.name AND b.type = fsobject.type AND b.size_in_bytes = fsobject.size_in_bytes " \
+            "AND b.mtime_ns = fsobject.mtime_ns AND b.inode = fsobject.inode AND (b.content_hash IS NOT NULL OR b.partial_hash IS NOT NULL)".format(base=base)
+        self.db.execDelete(query, (baseScanId, self.scanId, self.FSOBJECT_TYPE_FILE,
+                                   self.FSOBJECT_STATE_PENDING), False)
+        self.db.execDelete("DELETE FROM temp.folder_pair", None, True)
+        if baseScanId != self.scanId:
+            self.db.detachScan(baseScanId)
+
+        query = "SELECT COUNT(*) FROM fsobject WHERE scan_id = ? AND type = ? AND state = ? AND (content_hash IS NOT NULL OR partial_hash IS NOT NULL)"
+        return self.db.fetchAll(query, (self.scanId, self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_PENDING))[0][0]
 
     def markDuplicateFiles(self):
+        """
+        Identifies duplicate files in stages, every stage is recorded as file state so an interrupted
+        scan resumes from the stage it was in.
+        1. Files with unique size are unique.
+        2. Hash of first and last few KB for remaining files, files unique by (size, partial hash) are unique.
+        3. Full content hash only for files whose partial hash collides.
+        4. Optionally strong hash of files whose non-cryptographic content hash collides.
+        Files that vanish or can not be read are UNREADABLE. After a stop request it returns once the running
+        hash step has written its results, later steps would see files that are not hashed yet.
+        """
         # 1. Mark all files as unique who as unique size in bytes, there content cannot be same / duplicate.
-        query = "UPDATE fsobject SET state = {state} WHERE scan_id = {scanId} AND type = {type} AND size_in_bytes IN (SELECT size_in_bytes FROM fsobject WHERE scan_id = {scanId} AND type = {type} GROUP BY size_in_bytes HAVING COUNT(*) = 1)".format(
-            scanId=self.scanId, type=self.FSOBJECT_TYPE_FILE, state=self.FSOBJECT_STATE_UNIQUE_BY_SIZE)
-        self.db.execDelete(query, None, True)
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ? AND size_in_bytes IN " \
+            "(SELECT size_in_bytes FROM fsobject WHERE scan_id = ? AND type = ? GROUP BY size_in_bytes HAVING COUNT(*) = 1)"
+        self.db.execDelete(query, (self.FSOBJECT_STATE_UNIQUE_BY_SIZE, self.scanId, self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_PENDING,
+                                   self.scanId, self.FSOBJECT_TYPE_FILE), True)
 
-        # 2. Compute pending content hash
-        # 2.a Get all pending files, there should not be any pending file to move to next step.
-        query = "SELECT id, full_path FROM fsobject WHERE scan_id = {scanId} AND type = {type} AND state = {state}".format(
-            scanId=self.scanId, type=self.FSOBJECT_TYPE_FILE, state=self.FSOBJECT_STATE_PENDING)
+        # 2. Compute partial hash of all pending files.
+        self.computePartialHashes()
+        if self.stopEvent.is_set():
+            return
 
-        pFiles = self.db.fetchAll(query, None)
-        hash = Hash()
-        for pFile in pFiles:
-            self.clog.info("Computing hash for {pFile}".format(pFile=pFile))
+        # 2.a Mark files as unique whose partial hash does not match any other file of same size. Files of a resumed
+        # scan may already be in a later state, so every file with partial hash is counted.
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ? AND (size_in_bytes, partial_hash) IN " \
+            "(SELECT size_in_bytes, partial_hash FROM fsobject WHERE scan_id = ? AND type = ? AND partial_hash IS NOT NULL GROUP BY size_in_bytes, partial_hash HAVING COUNT(*) = 1)"
+        self.db.execDelete(query, (self.FSOBJECT_STATE_UNIQUE_BY_PARTIAL_HASH, self.scanId, self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_PARTIAL_HASH_COMPUTED,
+                                   self.scanId, self.FSOBJECT_TYPE_FILE), True)
 
-            # 2.a.1 Read file content and compute hash
-            hash.setFilePath(self.utility.decodeDBString(pFile[1]))
+        # 3. Compute full content hash of files whose partial hash collides.
+        self.computeContentHashes()
+        if self.stopEvent.is_set():
+            return
 
-            # 2.a.2 Update content hash
-            query = "UPDATE fsobject SET content_hash = '{h}', state = {state} WHERE id = {scanId}".format(
-                scanId=pFile[0], state=self.FSOBJECT_STATE_HASH_COMPUTED, h=hash.getFileHash())
+        # 4. Once all hash computes are done, mark duplicate based on content hash and size. Collisions of a
+        # non-cryptographic hash are only candidates when they have to be confirmed.
+        duplicateState = self.FSOBJECT_STATE_FAST_HASH_COLLISION if self.confirmCollisions else self.FSOBJECT_STATE_DUPLICATE_BY_HASH
+        self.markSharedHashes(
+            self.FSOBJECT_STATE_HASH_COMPUTED, duplicateState)
 
-            self.db.execDelete(query, None, False)
+        # 5. Mark all remaining files as unique whose size match but hash does not match
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ?"
+        self.db.execDelete(query, (self.FSOBJECT_STATE_UNIQUE_BY_HASH, self.scanId,
+                                   self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_HASH_COMPUTED), True)
 
-        # 2.b Commit all hash update to database
+        # 6. Confirm collisions with strong hash.
+        if self.confirmCollisions:
+            self.confirmFastHashCollisions()
+
+    def markSharedHashes(self, state, duplicateState):
+        """
+        Moves files of a state to duplicateState when another file of either state has the same size and content hash,
+        files of different size never share content even if a short non-cryptographic hash collides.
+        Files are grouped by integer hash prefix and size, which are read from fsobject_scan_type_state_prefix_size index
+        alone. Groups whose files still differ in full hash are split again by full hash, files left without a twin go
+        back to the state.
+        """
+        # 1. Files that share hash prefix and size.
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ? AND (hash_prefix, size_in_bytes) IN " \
+            "(SELECT hash_prefix, size_in_bytes FROM fsobject WHERE scan_id = ? AND type = ? AND state IN (?, ?) GROUP BY hash_prefix, size_in_bytes HAVING COUNT(*) > 1)"
+        self.db.execDelete(query, (duplicateState, self.scanId, self.FSOBJECT_TYPE_FILE, state,
+                                   self.scanId, self.FSOBJECT_TYPE_FILE, state, duplicateState), True)
+
+        # 2. Prefix and size groups with more than one full hash.
+        query = "SELECT hash_prefix, size_in_bytes FROM fsobject WHERE scan_id = ? AND type = ? AND state = ? " \
+            "GROUP BY hash_prefix, size_in_bytes HAVING MIN(content_hash) != MAX(content_hash)"
+        groups = self.db.fetchAll(
+            query, (self.scanId, self.FSOBJECT_TYPE_FILE, duplicateState))
+
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ? AND hash_prefix = ? AND size_in_bytes = ? AND content_hash IN " \
+            "(SELECT content_hash FROM fsobject WHERE scan_id = ? AND type = ? AND state = ? AND hash_prefix = ? AND size_in_bytes = ? " \
+            "GROUP BY content_hash HAVING COUNT(*) = 1)"
+        for hashPrefix, sizeInBytes in groups:
+            self.db.execDelete(query, (state, self.scanId, self.FSOBJECT_TYPE_FILE, duplicateState, hashPrefix, sizeInBytes,
+                                       self.scanId, self.FSOBJECT_TYPE_FILE, duplicateState, hashPrefix, sizeInBytes), False)
         self.db.commit()
 
-        # 3. Once all hash computes are done, mark duplicate based on content hash and size
-        query = "UPDATE fsobject SET state = {setState} WHERE scan_id = {scanId} AND type = {type} AND state = {currState} AND content_hash IN (SELECT content_hash FROM fsobject WHERE scan_id = {scanId} AND type = {type} GROUP BY content_hash HAVING COUNT(*) > 1)".format(
-            scanId=self.scanId, type=self.FSOBJECT_TYPE_FILE, setState=self.FSOBJECT_STATE_DUPLICATE_BY_HASH, currState=self.FSOBJECT_STATE_HASH_COMPUTED
-        )
-        self.db.execDelete(query, None, True)
+        if groups:
+            self.clog.warning("Scan id: %ld, Split %d hash prefix groups by full hash",
+                              self.scanId, len(groups))
 
-        # 4. Mark all remaining files as unique whose size match but hash does not match
-        query = "UPDATE fsobject SET state = {setState} WHERE scan_id = {scanId} AND type = {type} AND state = {currState}".format(
-            scanId=self.scanId, type=self.FSOBJECT_TYPE_FILE, setState=self.FSOBJECT_STATE_UNIQUE_BY_HASH, currState=self.FSOBJECT_STATE_PENDING
-        )
-        self.db.execDelete(query, None, True)
+    def computePartialHashes(self):
+        """
+        Moves all PENDING files to PARTIAL_HASH_COMPUTED. Files small enough to be read completely get
+        their content hash as well.
+        """
+        # 1. Files that already have partial hash from previous scan just change state.
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ? AND partial_hash IS NOT NULL"
+        self.db.execDelete(query, (self.FSOBJECT_STATE_PARTIAL_HASH_COMPUTED, self.scanId,
+                                   self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_PENDING), True)
 
-    def updateFolderSize(self):
-        # 1. Repeat below loop till we find any folder without size.
-        while True:
-            # 1.a Get directories whose size is not updated.
-            query = "SELECT id FROM fsobject WHERE scan_id = {scanId} AND type = {type} AND size_in_bytes = -1".format(
-                scanId=self.scanId, type=self.FSOBJECT_TYPE_FOLDER
-            )
-            pDirs = self.db.fetchAll(query, None)
-            if pDirs:
-                for pDir in pDirs:
-                    # 1.a Check if all sub items in directory have proper size
-                    query = "SELECT COUNT(*) FROM fsobject WHERE scan_id = {scanId} AND parent_id = {parentId} AND size_in_bytes = -1".format(
-                        scanId=self.scanId, parentId=pDir[0]
-                    )
-                    if self.db.fetchAll(query, None)[0][0] == 0:
-                        # All sub items have size set, so lets update parent directory size
-                        query = "UPDATE fsobject SET size_in_bytes = (SELECT SUM(size_in_bytes) FROM fsobject WHERE scan_id = {scanId} AND parent_id = {parentId}) WHERE id = {parentId}".format(
-                            scanId=self.scanId, parentId=pDir[0]
-                        )
-                        self.db.execDelete(query, None, True)
+        # 2. Read head and tail of remaining files.
+        pFiles = self.getFiles(self.FSOBJECT_STATE_PENDING)
+
+        hash = self.hash
+        updates = []
+        jobs = []
+        updateQuery = "UPDATE fsobject SET partial_hash = ?, content_hash = ?, hash_prefix = ?, state = ? WHERE id = ?"
+        for pFile in pFiles:
+            # 2.a Full hash from cache is kept for the full hash stage, small files need no read at all.
+            fileHash = self.hashCache.lookup(
+                hash.algorithm, pFile[2], pFile[3], pFile[4], pFile[5])
+            if fileHash is not None and pFile[4] <= 2 * self.partialHashSampleBytes:
+                updates.append((fileHash, fileHash, hash.getPrefix(fileHash),
+                                self.FSOBJECT_STATE_PARTIAL_HASH_COMPUTED, pFile[0]))
             else:
-                # Break the loop
-                break
+                jobs.append((pFile, fileHash))
+
+        # 2.b Read samples on hash engine threads.
+        def computeSample(job):
+            return self.readFile(hash.computeSampleHash, job[0][1], job[0][4], self.partialHashSampleBytes)
+
+        for (pFile, fileHash), sample in self.hashEngine.run(jobs, computeSample, lambda job: job[0][2], lambda job: job[0][3]):
+            if sample is None:
+                updates.append((None, None, None, self.FSOBJECT_STATE_UNREADABLE, pFile[0]))
+            else:
+                partialHash, isComplete = sample
+                if isComplete:
+                    fileHash = partialHash
+                    self.hashCache.store(
+                        hash.algorithm, pFile[2], pFile[3], pFile[4], pFile[5], fileHash)
+
+                updates.append((partialHash, fileHash, hash.getPrefix(fileHash),
+                                self.FSOBJECT_STATE_PARTIAL_HASH_COMPUTED, pFile[0]))
+            if len(updates) >= self.UPDATE_BATCH_SIZE:
+                self.hashCache.flush()
+                self.db.execMany(updateQuery, updates, True)
+                updates = []
+
+        self.hashCache.flush()
+        self.db.execMany(updateQuery, updates, True)
+
+        self.clog.critical(
+            "Scan id: %ld, Computed partial hash of %d files", self.scanId, len(pFiles))
+
+    def computeContentHashes(self):
+        """
+        Moves all PARTIAL_HASH_COMPUTED files to HASH_COMPUTED, reading only files whose content hash
+        is neither known already nor present in hash cache.
+        """
+        # 1. Files with content hash from partial stage or previous scan just change state.
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ? AND content_hash IS NOT NULL"
+        self.db.execDelete(query, (self.FSOBJECT_STATE_HASH_COMPUTED, self.scanId,
+                                   self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_PARTIAL_HASH_COMPUTED), True)
+
+        # 2. Get all remaining files, there should not be any such file to move to next step.
+        pFiles = self.getFiles(self.FSOBJECT_STATE_PARTIAL_HASH_COMPUTED)
+
+        # 3. Hash cache is already checked in partial hash stage, read file content and compute hash.
+        self.hashFiles(pFiles, self.hash, self.FSOBJECT_STATE_HASH_COMPUTED)
+        self.hashCache.logStatistics(self.scanId)
+
+    def confirmFastHashCollisions(self):
+        """
+        Moves FAST_HASH_COLLISION files to DUPLICATE_BY_HASH or UNIQUE_BY_HASH based on their strong hash,
+        content hash of these files is replaced by the strong hash and kept in algorithm_hash.
+        """
+        pFiles = self.getFiles(self.FSOBJECT_STATE_FAST_HASH_COLLISION)
+
+        # 1. Use cached strong hashes, read only remaining files.
+        updates = []
+        remaining = []
+        for pFile in pFiles:
+            fileHash = self.hashCache.lookup(
+                self.confirmHash.algorithm, pFile[2], pFile[3], pFile[4], pFile[5])
+            if fileHash is None:
+                remaining.append(pFile)
+            else:
+                updates.append((fileHash, fileHash, self.confirmHash.getPrefix(fileHash),
+                                self.FSOBJECT_STATE_CONFIRM_HASH_COMPUTED, pFile[0]))
+
+        self.db.execMany(self.HASH_UPDATE_QUERY, updates, True)
+        self.hashFiles(remaining, self.confirmHash,
+                       self.FSOBJECT_STATE_CONFIRM_HASH_COMPUTED)
+        if self.stopEvent.is_set():
+            return
+
+        # 2. Group by strong hash.
+        self.markSharedHashes(self.FSOBJECT_STATE_CONFIRM_HASH_COMPUTED,
+                              self.FSOBJECT_STATE_DUPLICATE_BY_HASH)
+
+        query = "UPDATE fsobject SET state = ? WHERE scan_id = ? AND type = ? AND state = ?"
+        self.db.execDelete(query, (self.FSOBJECT_STATE_UNIQUE_BY_HASH, self.scanId,
+                                   self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_CONFIRM_HASH_COMPUTED), True)
+
+        self.clog.critical(
+            "Scan id: %ld, Confirmed %d fast hash collisions with %s", self.scanId, len(pFiles), self.confirmHash.algorithm)
+
+    def hashFiles(self, pFiles, hash, newState):
+        """
+        Computes content hash of files on hash engine and stores it with new state in batches.
+        :param pFiles: Tuples of (id, full path, device, inode, size_in_bytes, mtime_ns) as returned by getFiles().
+        """
+        updates = []
+        updateQuery = self.HASH_UPDATE_QUERY
+
+        def computeHash(pFile):
+            return self.readFile(hash.computeFileHash, pFile[1])
+
+        for pFile, fileHash in self.hashEngine.run(pFiles, computeHash, lambda pFile: pFile[2], lambda pFile: pFile[3]):
+            if fileHash is None:
+                updates.append((None, None, None, self.FSOBJECT_STATE_UNREADABLE, pFile[0]))
+            else:
+                self.hashCache.store(
+                    hash.algorithm, pFile[2], pFile[3], pFile[4], pFile[5], fileHash)
+                updates.append(
+                    (fileHash, fileHash, hash.getPrefix(fileHash), newState, pFile[0]))
+            if len(updates) >= self.UPDATE_BATCH_SIZE:
+                self.hashCache.flush()
+                self.db.execMany(updateQuery, updates, True)
+                updates = []
+
+        # Commit all hash update to database
+        self.hashCache.flush()
+        self.db.execMany(updateQuery, updates, True)
+
+    def readFile(self, func, filePath, *args):
+        """
+        Calls a hash function of a file, file removed or made unreadable since the walk is skipped. Runs on hash engine threads.
+        :return: Result of func, None if file could not be read.
+        """
+        try:
+            return func(filePath, *args)
+        except OSError as ex:
+            self.clog.warning("Scan id: %ld, Skipping unreadable file: %s (%s)", self.scanId, filePath, ex)
+            return None
+
+    def verifyDuplicateFiles(self):
+        """
+        Confirms DUPLICATE_BY_HASH files by comparing their content byte by byte within each content hash
+        and size group. Files equal to another file become DUPLICATE_BY_CONTENT, others UNIQUE_BY_CONTENT. If a
+        group splits into several classes of identical files, every class after the first gets a suffix
+        content hash derived from the group hash, see Hash.computeClassHash(), so later stages do not group them together.
+        """
+        folderPrefixes = self.getFolderPrefixes()
+        query = "SELECT id, parent_id, name, content_hash, size_in_bytes FROM fsobject WHERE scan_id = ? AND type = ? AND state = ? " \
+            "ORDER BY content_hash, size_in_bytes, id"
+        pFiles = [(row[0], folderPrefixes[row[1]] + row[2], row[3], row[4]) for row in self.db.fetchAll(
+            query, (self.scanId, self.FSOBJECT_TYPE_FILE, self.FSOBJECT_STATE_DUPLICATE_BY_HASH))]
+
+        updateQuery = self.HASH_UPDATE_QUERY
+        updates = []
+        splitGroups = 0
+        start = 0
+        while start < len(pFiles) and not self.stopEvent.is_set():
+            # 1. Collect files of one content hash and size group.
+            end = start
+            while end < len(pFiles) and pFiles[end][2:] == pFiles[start][2:]:
+                end += 1
+            group = pFiles[start:end]
+            start = end
+
+            # 2. Compare the group and record result of every file.
+            ids = {pFile[1]: pFile[0] for pFile in group}
+            classes = self.compare.splitGroup(list(ids))
+            if len(classes) > 1:
+                splitGroups += 1
+
+            suffix = 0
+            for fileClass in classes:
+                if len(fileClass) == 1:
+                    updates.append((group[0][2], group[0][2], self.hash.getPrefix(group[0][2]),
+                                    self.FSOBJECT_STATE_UNIQUE_BY_CONTENT, ids[fileClass[0]]))
+                    continue
+
+                contentHash = group[0][2] if suffix == 0 else self.hash.computeClassHash(
+                    group[0][2], suffix)
+                suffix += 1
+                for path in fileClass:
+                    updates.append((contentHash, contentHash, self.hash.getPrefix(contentHash),
+                                    self.FSOBJECT_STATE_DUPLICATE_BY_CONTENT, ids[path]))
+
+            # 3. Write results of complete groups only, so an interrupted stage resumes with whole groups.
+            if len(updates) >= self.UPDATE_BATCH_SIZE:
+                self.db.execMany(updateQuery, updates, True)
+                updates = []
+
+        self.db.execMany(updateQuery, updates, True)
+        self.clog.critical(
+            "Scan id: %ld, Verified content of %d duplicate files, %d hash groups had different content", self.scanId, len(pFiles), splitGroups)
+
+    def updateFolderSize(self):
+        """
+        Computes size of every folder in one bottom-up pass. A parent is always inserted before its
+        children, so visiting folders in descending id order sees every folder after all its sub folders.
+        Totals are kept in an array indexed by id offset and written back in one transaction.
+        """
+        # 1. Id range of the scan.
+        query = "SELECT MIN(id), MAX(id) FROM fsobject WHERE scan_id = ?"
+        minId, maxId = self.db.fetchAll(query, (self.scanId, ))[0]
+        if minId is None:
+            return
+
+        totals = array.array("q", bytes(8 * (maxId - minId + 1)))
+
+        # 2. Sum of file sizes directly in every folder.
+        query = "SELECT parent_id, SUM(size_in_bytes) FROM fsobject WHERE scan_id = ? AND type = ? GROUP BY parent_id"
+        for parentId, sizeInBytes in self.db.fetchAll(query, (self.scanId, self.FSOBJECT_TYPE_FILE)):
+            totals[parentId - minId] = sizeInBytes
+
+        # 3. Add every folder total to its parent, deepest folders come first.
+        query = "SELECT id, parent_id FROM fsobject WHERE scan_id = ? AND type = ? ORDER BY id DESC"
+        updates = []
+        for folderId, parentId in self.db.fetchAll(query, (self.scanId, self.FSOBJECT_TYPE_FOLDER)):
+            sizeInBytes = totals[folderId - minId]
+            if parentId >= minId:
+                totals[parentId - minId] += sizeInBytes
+            updates.append((sizeInBytes, folderId))
+
+        # 4. Write all folder sizes in one transaction.
+        self.db.execMany(
+            "UPDATE fsobject SET size_in_bytes = ? WHERE id = ?", updates, True)
+        self.clog.critical(
+            "Scan id: %ld, Updated size of %d folders", self.scanId, len(updates))
 
     def markFolderAsDuplicate(self):
-        # 1. Repeat below loop till we find any folder with pending state.
-        while True:
-            # 1.a Get directories whose state is PENDING.
-            query = "SELECT id FROM fsobject WHERE scan_id = {scanId} AND type = {type} AND state = {state}".format(
-                scanId=self.scanId, type=self.FSOBJECT_TYPE_FOLDER, state=self.FSOBJECT_STATE_PENDING
-            )
-            pDirs = self.db.fetchAll(query, None)
-            if pDirs:
-                for pDir in pDirs:
-                    # 1.a Check if all sub items in directory have state which is not PENDING
-                    query = "SELECT COUNT(*) FROM fsobject WHERE scan_id = {scanId} AND parent_id = {parentId} AND state = {state}".format(
-                        scanId=self.scanId, parentId=pDir[0], state=self.FSOBJECT_STATE_PENDING
-                    )
-                    if self.db.fetchAll(query, None)[0][0] == 0:
-                        # All sub items in a folder should be marked as duplicate in order to make folder as duplicate.
-                        # 1. Get all items in folder
-                        totalItemsQuery = "SELECT COUNT(*) FROM fsobject WHERE scan_id = {scanId} AND parent_id = {parentId}".format(
-                            scanId=self.scanId, parentId=pDir[0]
-                        )
-
-                        # 2. Get all items that are duplicate
-                        duplicateItemsQuery = "SELECT COUNT(*) FROM fsobject WHERE scan_id = {scanId} AND parent_id = {parentId} AND state IN ({state1}, {state2})".format(
-                            scanId=self.scanId, parentId=pDir[0], state1=self.FSOBJECT_STATE_DUPLICATE_BY_HASH, state2=self.FSOBJECT_STATE_DUPLICATE_BY_SUBITEM
-                        )
-
-                        # 3. Mark folder as DUPLICATE if total == duplicate i.e., we have all sub item as duplicate.
-                        query = "SELECT CASE ({totalItemsQuery}) WHEN ({duplicateItemsQuery}) THEN 1 ELSE 0 END".format(
-                            totalItemsQuery=totalItemsQuery, duplicateItemsQuery=duplicateItemsQuery
-                        )
-                        if self.db.fetchAll(query, None)[0][0] == 1:
-                            # Compute hash of sum of all sub item hash
-                            query = "SELECT content_hash FROM fsobject WHERE scan_id = {scanId} AND parent_id = {parentId}".format(
-                                scanId=self.scanId, parentId=pDir[0]
-                            )
-                            rows = self.db.fetchAll(query, None)
-                            subItemHashes = ""
-                            for row in rows:
-                                subItemHashes = subItemHashes + row[0]
-
-                            hash = Hash()
-                            query = "UPDATE fsobject SET state = {state}, content_hash = '{hash}' WHERE scan_id = {scanId} AND id = {id}".format(
-                                id=pDir[0], scanId=self.scanId, state=self.FSOBJECT_STATE_DUPLICATE_BY_SUBITEM, hash=hash.computeStringHash(
-                                    subItemHashes)
-                            )
-                            self.db.execDelete(query, None, True)
-                        else:
-                            # Mark folder as unique by subitem
-                            query = "UPDATE fsobject SET state = {state} WHERE scan_id = {scanId} AND id = {id}".format(
-                                id=pDir[0], scanId=self.scanId, state=self.FSOBJECT_STATE_UNIQUE_BY_SUBITEM
-                            )
-                            self.db.execDelete(query, None, True)
-                    else:
-                        # Mark folder as unique by subitem
-                        query = "UPDATE fsobject SET state = {state} WHERE scan_id = {scanId} AND id = {id}".format(
-                                id=pDir[0], scanId=self.scanId, state=self.FSOBJECT_STATE_UNIQUE_BY_SUBITEM
-                        )
-                        self.db.execDelete(query, None, True)
+        """
+        Marks folders whose whole subtree is identical to another folder. Folder hash is a Merkle hash of
+        sorted (content hash, size) tuples of its children, computed in one bottom-up pass, names do not
+        take part. A folder with any unique file or unique sub folder can not have an identical twin, so it
+        gets no hash. Folders are then grouped by hash, groups with more than one folder are duplicates.
+        """
+        duplicateFileStates = (self.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                               self.FSOBJECT_STATE_DUPLICATE_BY_CONTENT)
+
+        # 1. Child tuples of every folder from its files, folders with a unique file are unique.
+        children = {}
+        uniqueFolders = set()
+        query = "SELECT parent_id, state, content_hash, size_in_bytes FROM fsobject WHERE scan_id = ? AND type = ?"
+        for parentId, state, contentHash, sizeInBytes in self.db.fetchAll(query, (self.scanId, self.FSOBJECT_TYPE_FILE)):
+            if state in duplicateFileStates:
+                children.setdefault(parentId, []).append(
+                    (contentHash, sizeInBytes))
             else:
-                # Break the loop
-                break
+                uniqueFolders.add(parentId)
+
+        # 2. Bottom-up pass, a parent is always inserted before its children.
+        hash = Hash()
+        folderHashes = []
+        hashCounts = {}
+        query = "SELECT id, parent_id, size_in_bytes FROM fsobject WHERE scan_id = ? AND type = ? ORDER BY id DESC"
+        for folderId, parentId, sizeInBytes in self.db.fetchAll(query, (self.scanId, self.FSOBJECT_TYPE_FOLDER)):
+            folderChildren = children.pop(folderId, [])
+            if folderId in uniqueFolders:
+                uniqueFolders.discard(folderId)
+                uniqueFolders.add(parentId)
+                folderHashes.append((folderId, None))
+                continue
+
+            folderChildren.sort()
+            folderHash = hash.computeStringHash("\n".join(
+                "{h}:{size}".format(h=h.hex(), size=size) for h, size in folderChildren))
+            children.setdefault(parentId, []).append(
+                (folderHash, sizeInBytes))
+            folderHashes.append((folderId, folderHash))
+            hashCounts[folderHash] = hashCounts.get(folderHash, 0) + 1
+
+        # 3. Group folders by hash and write all folder states in one transaction.
+        updates = []
+        duplicates = 0
+        for folderId, folderHash in folderHashes:
+            if folderHash is not None and hashCounts[folderHash] > 1:
+                duplicates += 1
+                updates.append((self.FSOBJECT_STATE_DUPLICATE_BY_SUBITEM,
+                                folderHash, hash.getPrefix(folderHash), folderId))
+            else:
+                updates.append((self.FSOBJECT_STATE_UNIQUE_BY_SUBITEM,
+                                folderHash, hash.getPrefix(folderHash), folderId))
+
+        self.db.execMany(
+            "UPDATE fsobject SET state = ?, content_hash = ?, hash_prefix = ? WHERE id = ?", updates, True)
+        self.clog.critical(
+            "Scan id: %ld, Found %d duplicate folders out of %d", self.scanId, duplicates, len(updates))
 
-    def deleteAllForScanId(self):
-        query = "DELETE FROM fsobject WHERE scan_id = {scanId}".format(
-            scanId=self.scanId)
-        self.db.execDelete(query, None, True)
+    def deleteAllForScanId(self, scanId=None):
+        """
+        :param scanId: Scan whose objects are deleted, None is the current scan.
+        """
+        query = "DELETE FROM fsobject WHERE scan_id = ?"
+        self.db.execDelete(
+            query, (self.scanId if scanId is None else scanId, ), True)
@@ -1,17 +1,90 @@
 import os
+import mmap
+import zlib
 import logging
 import hashlib
+import threading
 
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class Crc32Hash:
+    """
+    hashlib like wrapper of zlib.crc32, used as fast non-cryptographic prefilter.
+    """
 
-class Hash:
     def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, "big")
+
+
+class Hash:
+    # Supported hash algorithms, algorithm used by a scan is stored on the scan row.
+    ALGORITHM_SHA256 = "sha256"
+    ALGORITHM_BLAKE2B = "blake2b"
+    ALGORITHM_XXH64 = "xxh64"
+    ALGORITHM_CRC32 = "crc32"
+
+    # Algorithm constructors and whether algorithm is cryptographic.
+    ALGORITHMS = {
+        ALGORITHM_SHA256: (hashlib.sha256, True),
+        ALGORITHM_BLAKE2B: (lambda: hashlib.blake2b(digest_size=32), True),
+        ALGORITHM_XXH64: (lambda: xxhash.xxh64(), False),
+        ALGORITHM_CRC32: (Crc32Hash, False)
+    }
+
+    DEFAULT_ALGORITHM = ALGORITHM_SHA256
+
+    # Strong algorithm used to confirm collisions of a non-cryptographic algorithm.
+    CONFIRM_ALGORITHM = ALGORITHM_SHA256
+
+    # Hashes are stored as raw digest bytes, first bytes are also stored as integer for grouping.
+    PREFIX_BYTES = 8
+
+    # Size of the reusable read buffer.
+    BLOCK_SIZE = 1024 * 1024
+
+    # Files of this size or larger are hashed through mmap, None disables mmap.
+    MMAP_THRESHOLD = None
+
+    def __init__(self, blockSize=BLOCK_SIZE, mmapThreshold=MMAP_THRESHOLD, algorithm=DEFAULT_ALGORITHM):
         # Set logger
         self.clog = logging.getLogger("CORE.HASH")
 
+        # Hash algorithm
+        self.setAlgorithm(algorithm)
+
         # Set file path and hash value
         self.filePath = None
         self.fileHash = None
 
+        # Read settings, every thread gets its own preallocated buffer.
+        self.blockSize = blockSize
+        self.mmapThreshold = mmapThreshold
+        self.threadData = threading.local()
+
+    def setAlgorithm(self, algorithm):
+        if algorithm not in self.ALGORITHMS:
+            raise Exception("Unknown hash algorithm: {algorithm}".format(
+                algorithm=algorithm))
+        if algorithm == self.ALGORITHM_XXH64 and xxhash is None:
+            raise Exception(
+                "Hash algorithm xxh64 requires xxhash package, install it with: pip install xxhash")
+
+        self.algorithm = algorithm
+        self.newHash = self.ALGORITHMS[algorithm][0]
+
+    def isCryptographic(self):
+        return self.ALGORITHMS[self.algorithm][1]
+
     def setFilePath(self, filePath):
         self.filePath = filePath
         self.fileHash = self.compute()
@@ -20,15 +93,94 @@ class Hash:
         return self.fileHash
 
     def compute(self):
-        sha256Hash = hashlib.sha256()
-        with open(self.filePath, "rb") as f:
-            # Read and update hash in blocks of 4K
-            for byteBlock in iter(lambda: f.read(4096), b""):
-                sha256Hash.update(byteBlock)
+        return self.computeFileHash(self.filePath)
+
+    def getBuffer(self):
+        """
+        Returns memoryview of the read buffer of calling thread, buffer is allocated once per thread.
+        """
+        buffer = getattr(self.threadData, "buffer", None)
+        if buffer is None:
+            buffer = memoryview(bytearray(self.blockSize))
+            self.threadData.buffer = buffer
+
+        return buffer
+
+    def updateFromFile(self, hashObject, f):
+        """
+        Reads rest of the file into reusable buffer and updates hash, no bytes object is created per block.
+        """
+        buffer = self.getBuffer()
+        readinto = f.readinto
+        update = hashObject.update
+        while True:
+            count = readinto(buffer)
+            if not count:
+                break
+            update(buffer[:count])
+
+    def updateFromMmap(self, hashObject, f, sizeInBytes):
+        """
+        Maps the file and hashes it in blocks of blockSize without copying it.
+        """
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for offset in range(0, sizeInBytes, self.blockSize):
+                    hashObject.update(view[offset:offset + self.blockSize])
+            finally:
+                view.release()
 
-            return sha256Hash.hexdigest()
+    def computeFileHash(self, filePath):
+        """
+        Computes content hash of given file, does not change state of the object so it can be
+        called from multiple threads.
+        """
+        fileHash = self.newHash()
+        with open(filePath, "rb", buffering=0) as f:
+            sizeInBytes = os.fstat(f.fileno()).st_size
+            if self.mmapThreshold is not None and sizeInBytes > 0 and sizeInBytes >= self.mmapThreshold:
+                self.updateFromMmap(fileHash, f, sizeInBytes)
+            else:
+                self.updateFromFile(fileHash, f)
+
+            return fileHash.digest()
+
+    def computeSampleHash(self, filePath, sizeInBytes, sampleBytes):
+        """
+        Computes hash of first and last sampleBytes of the file. Files not larger than two samples
+        are read completely, so for them the result is same as the full content hash.
+        :return: Tuple (hash, True if whole file was read).
+        """
+        fileHash = self.newHash()
+        with open(filePath, "rb", buffering=0) as f:
+            if sizeInBytes <= 2 * sampleBytes:
+                self.updateFromFile(fileHash, f)
+
+                return fileHash.digest(), True
+
+            fileHash.update(f.read(sampleBytes))
+            f.seek(-sampleBytes, os.SEEK_END)
+            fileHash.update(f.read(sampleBytes))
+
+            return fileHash.digest(), False
 
     def computeStringHash(self, data):
         sha256Hash = hashlib.sha256()
         sha256Hash.update(data.encode('utf-8'))
-        return sha256Hash.hexdigest()
+        return sha256Hash.digest()
+
+    def getPrefix(self, contentHash):
+        """
+        :return: First PREFIX_BYTES of the hash as signed integer, None for no hash.
+        """
+        if contentHash is None:
+            return None
+
+        return int.from_bytes(contentHash[:self.PREFIX_BYTES], "big", signed=True)
+
+    def computeClassHash(self, contentHash, classNumber):
+        """
+        Derives hash of a class of identical files that shares content hash with other classes, see FsObject.verifyDuplicateFiles().
+        """
+        return self.computeStringHash("{h}:{n}".format(h=contentHash.hex(), n=classNumber))
@@ -0,0 +1,107 @@
+import time
+import logging
+
+# Class stores content hash of files across scans, a file is identified by its device, inode,
+# size and mtime so a hash is reused only when file is not modified since it was hashed.
+# Hashes of different algorithms are kept apart.
+
+
+class HashCache:
+    # Default eviction limits, entries not used for this many days are removed.
+    MAX_AGE_DAYS = 90
+
+    # Maximum number of entries kept, least recently used entries are removed first.
+    MAX_ROWS = 50000000
+
+    def __init__(self, db, maxAgeDays=MAX_AGE_DAYS, maxRows=MAX_ROWS):
+        # Create logger
+        self.clog = logging.getLogger("CORE.HASH_CACHE")
+
+        # DB object
+        self.db = db
+
+        # Eviction limits, None disables the limit.
+        self.maxAgeDays = maxAgeDays
+        self.maxRows = maxRows
+
+        # Pending writes, flushed in a batch.
+        self.pendingStores = []
+        self.pendingTouches = []
+
+        self.resetStatistics()
+
+    def resetStatistics(self):
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def lookup(self, algorithm, device, inode, sizeInBytes, mtimeNs):
+        """
+        :return: Cached content hash of the file or None if file is not in cache.
+        """
+        if device is None or inode is None or mtimeNs is None:
+            self.misses += 1
+            return None
+
+        query = "SELECT content_hash FROM hash_cache WHERE device = ? AND inode = ? AND size_in_bytes = ? AND mtime_ns = ? AND algorithm = ?"
+        row = self.db.fetchAll(
+            query, (device, inode, sizeInBytes, mtimeNs, algorithm))
+        if not row:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.pendingTouches.append((int(round(time.time() * 1000)),
+                                    device, inode, sizeInBytes, mtimeNs, algorithm))
+        return row[0][0]
+
+    def store(self, algorithm, device, inode, sizeInBytes, mtimeNs, contentHash):
+        """
+        Adds content hash of a file to the cache, call flush() to write it.
+        """
+        if device is None or inode is None or mtimeNs is None:
+            return
+
+        timestamp = int(round(time.time() * 1000))
+        self.pendingStores.append((device, inode, sizeInBytes, mtimeNs, algorithm,
+                                   contentHash, timestamp, timestamp))
+        self.stores += 1
+
+    def flush(self):
+        """
+        Writes pending entries and access times, caller is responsible for the commit.
+        """
+        if self.pendingStores:
+            query = "INSERT OR REPLACE INTO hash_cache(device, inode, size_in_bytes, mtime_ns, algorithm, content_hash, created_timestamp, accessed_timestamp) " \
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+            self.db.execMany(query, self.pendingStores, False)
+            self.pendingStores = []
+
+        if self.pendingTouches:
+            query = "UPDATE hash_cache SET accessed_timestamp = ? WHERE device = ? AND inode = ? AND size_in_bytes = ? AND mtime_ns = ? AND algorithm = ?"
+            self.db.execMany(query, self.pendingTouches, False)
+            self.pendingTouches = []
+
+    def evict(self):
+        """
+        Removes entries older than max age and least recently used entries above max rows.
+        """
+        if self.maxAgeDays is not None:
+            cutoff = int(round(time.time() * 1000)) - \
+                self.maxAgeDays * 24 * 60 * 60 * 1000
+            query = "DELETE FROM hash_cache WHERE accessed_timestamp < ?"
+            self.db.execDelete(query, (cutoff, ), True)
+
+        if self.maxRows is not None:
+            total = self.db.fetchAll(
+                "SELECT COUNT(*) FROM hash_cache", None)[0][0]
+            if total > self.maxRows:
+                query = "DELETE FROM hash_cache WHERE id IN (SELECT id FROM hash_cache ORDER BY accessed_timestamp ASC LIMIT ?)"
+                self.db.execDelete(query, (total - self.maxRows, ), True)
+                self.clog.warning(
+                    "Evicted %d least recently used hash cache entries", total - self.maxRows)
+
+    def logStatistics(self, scanId):
+        total = self.hits + self.misses
+        self.clog.critical("Scan id: %ld, Hash cache hits: %d misses: %d hit ratio: %.1f%% stored: %d",
+                           scanId, self.hits, self.misses, 100.0 * self.hits / total if total else 0, self.stores)
@@ -0,0 +1,162 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Class runs hash computations on a pool of threads. hashlib releases the GIL while hashing
+# large buffers and file reads release it while waiting on disk, so hashing scales with
+# the number of workers. Results are handed back to the calling thread, which remains the
+# only writer to the database.
+# Jobs can be scheduled per device, every device gets its own queue and workers so a spinning
+# disk is read sequentially while SSDs and other disks are kept busy in parallel.
+
+
+class HashEngine:
+    # Number of jobs queued per worker, bounds memory and the number of open files.
+    IN_FLIGHT_PER_WORKER = 4
+
+    # Workers for a rotational disk, more than one reader causes seeks.
+    ROTATIONAL_WORKERS = 1
+
+    # Device type as read from /sys/block.
+    DEVICE_TYPE_UNKNOWN = 0
+    DEVICE_TYPE_ROTATIONAL = 1
+    DEVICE_TYPE_SOLID_STATE = 2
+
+    def __init__(self, workers=1, maxInFlight=None, rotationalWorkers=ROTATIONAL_WORKERS, deviceWorkers=None, stopEvent=None):
+        """
+        :param workers: Number of hashing threads per solid state or unknown device. Jobs of a single device with one
+        worker are hashed on calling thread.
+        :param maxInFlight: Maximum jobs queued per device, default is IN_FLIGHT_PER_WORKER per worker.
+        :param rotationalWorkers: Number of hashing threads per rotational device.
+        :param deviceWorkers: Optional dict of st_dev to number of threads, overrides detected device type.
+        :param stopEvent: Optional threading.Event, once it is set no new job is started and run() ends after jobs in flight.
+        """
+        # Create logger
+        self.clog = logging.getLogger("CORE.HASH_ENGINE")
+
+        self.workers = max(1, workers)
+        self.maxInFlight = maxInFlight
+        self.rotationalWorkers = max(1, rotationalWorkers)
+        self.deviceWorkers = deviceWorkers or {}
+        self.stopEvent = stopEvent
+
+        # Device type by st_dev, /sys is read once per device.
+        self.deviceTypes = {}
+
+    def isStopped(self):
+        return self.stopEvent is not None and self.stopEvent.is_set()
+
+    def getDeviceType(self, device):
+        """
+        Detects whether st_dev is backed by a rotational disk using /sys/dev/block/<major>:<minor>.
+        Network and virtual file systems have no block device and are reported as unknown.
+        """
+        if device in self.deviceTypes:
+            return self.deviceTypes[device]
+
+        deviceType = self.DEVICE_TYPE_UNKNOWN
+        try:
+            sysPath = os.path.realpath("/sys/dev/block/{major}:{minor}".format(
+                major=os.major(device), minor=os.minor(device)))
+
+            # Partitions do not have queue folder, it belongs to parent disk.
+            for path in (sysPath, os.path.dirname(sysPath)):
+                rotationalFile = os.path.join(path, "queue", "rotational")
+                if os.path.exists(rotationalFile):
+                    with open(rotationalFile) as f:
+                        deviceType = self.DEVICE_TYPE_ROTATIONAL if f.read().strip() == "1" else self.DEVICE_TYPE_SOLID_STATE
+                    break
+        except (OSError, ValueError):
+            pass
+
+        self.deviceTypes[device] = deviceType
+        return deviceType
+
+    def getDeviceWorkers(self, device, deviceType):
+        if device in self.deviceWorkers:
+            return max(1, self.deviceWorkers[device])
+
+        if deviceType == self.DEVICE_TYPE_ROTATIONAL:
+            return self.rotationalWorkers
+
+        return self.workers
+
+    def buildQueues(self, jobs, deviceOf, inodeOf):
+        """
+        Groups jobs by device.
+        :return: List of tuple (device, workers, jobs), jobs of rotational device are sorted by inode.
+        """
+        if deviceOf is None:
+            return [(None, self.workers, list(jobs))]
+
+        byDevice = {}
+        for job in jobs:
+            byDevice.setdefault(deviceOf(job), []).append(job)
+
+        queues = []
+        for device, deviceJobs in byDevice.items():
+            deviceType = self.DEVICE_TYPE_UNKNOWN if device is None else self.getDeviceType(device)
+            if deviceType == self.DEVICE_TYPE_ROTATIONAL and inodeOf is not None:
+                # Inode order is close to on-disk order on most file systems.
+                deviceJobs.sort(key=inodeOf)
+
+            workers = self.getDeviceWorkers(device, deviceType)
+            self.clog.info("Hash queue for device %s (type %d): %d files, %d workers",
+                           device, deviceType, len(deviceJobs), workers)
+            queues.append((device, workers, deviceJobs))
+
+        return queues
+
+    def run(self, jobs, func, deviceOf=None, inodeOf=None):
+        """
+        Generator calls func(job) for every job and yields tuple (job, result) in completion order.
+        :param deviceOf: Optional function returning st_dev of a job, jobs are then queued per device.
+        :param inodeOf: Optional function returning inode of a job, used to order rotational device queue.
+        An exception raised by func is raised again on the calling thread. Jobs not started before stopEvent
+        was set are not yielded.
+        """
+        queues = self.buildQueues(jobs, deviceOf, inodeOf)
+
+        # Single device with one worker needs no pool, several devices are always read in parallel.
+        if len(queues) == 1 and queues[0][1] == 1:
+            for job in queues[0][2]:
+                if self.isStopped():
+                    return
+                yield job, func(job)
+            return
+
+        pools = []
+        try:
+            # Every device gets own pool and in-flight limit.
+            pending = []
+            for device, workers, deviceJobs in queues:
+                pool = ThreadPoolExecutor(
+                    max_workers=workers, thread_name_prefix="hash")
+                pools.append(pool)
+                limit = self.maxInFlight or workers * self.IN_FLIGHT_PER_WORKER
+                pending.append([pool, iter(deviceJobs), limit, 0])
+
+            inFlight = {}
+            while True:
+                # Top up every device queue, after stop only jobs in flight are finished.
+                for queue in pending:
+                    pool, deviceJobs, limit, count = queue
+                    while count < limit and not self.isStopped():
+                        job = next(deviceJobs, None)
+                        if job is None:
+                            break
+                        inFlight[pool.submit(func, job)] = (job, queue)
+                        count += 1
+                    queue[3] = count
+
+                if not inFlight:
+                    break
+
+                done, _ = wait(inFlight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job, queue = inFlight.pop(future)
+                    queue[3] -= 1
+                    yield job, future.result()
+        finally:
+            for pool in pools:
+                pool.shutdown(wait=True, cancel_futures=True)
@@ -1,18 +1,24 @@
 import time
 import logging
-from core.scan import Scan
+from core.hash import Hash
 
 
 class MainMenu:
-    def __init__(self):
+    def __init__(self, scan):
+        """
+        :param scan: Scan object used by every menu action, so its database connection and caches are kept.
+        """
         self.clog = logging.getLogger("CORE.MAIN_MENU")
+        self.scan = scan
         self.mainMenuObject = {
             1: {"title": "View all pending scans", "handler": self.handleViewAllPendingScans},
             2: {"title": "Process pending scans", "handler": self.handleProcessPendingScans},
             3: {"title": "View all scans", "handler": self.handleViewAllScans},
             4: {"title": "Show details of a scan", "handler": self.handleShowDetailsOfScan},
             5: {"title": "Start a new scan", "handler": self.handleStartNewScan},
-            6: {"title": "Exit", "handler": None}
+            6: {"title": "Delete a scan", "handler": self.handleDeleteScan},
+            7: {"title": "Retry a failed scan", "handler": self.handleRetryScan},
+            8: {"title": "Exit", "handler": None}
         }
 
         self.mainMenu = "\n\nSelect theh option from the below menu:\n"
@@ -24,30 +30,26 @@ class MainMenu:
             maxMenuIndex=self.maxMenuIndex)
 
     def display(self):
-        self.clog.critical(self.mainMenu)
-        menuOption = int(input())
-        if menuOption < 1 or menuOption > self.maxMenuIndex:
-            self.clog.critical(
-                "Invalid option entered for menu item, please select a valid option.")
-            self.display()
-        else:
+        while True:
+            self.clog.critical(self.mainMenu)
+            menuOption = int(input())
+            if menuOption < 1 or menuOption > self.maxMenuIndex:
+                self.clog.critical(
+                    "Invalid option entered for menu item, please select a valid option.")
+                continue
+
             if self.mainMenuObject[menuOption]["handler"] is None:
                 return
-            else:
-                self.mainMenuObject[menuOption]["handler"]()
-                self.display()
+
+            self.mainMenuObject[menuOption]["handler"]()
 
     def handleViewAllPendingScans(self):
         self.clog.critical("handleViewAllPendingScans() called")
 
-        # 1. Create a scan object
-        scan = Scan()
-
     def handleProcessPendingScans(self):
         self.clog.critical("handleProcessPendingScans() called")
 
-        scan = Scan()
-        scan.process()
+        self.scan.process()
 
     def handleViewAllScans(self):
         self.clog.critical("handleViewAllScans() called")
@@ -55,6 +57,22 @@ class MainMenu:
     def handleShowDetailsOfScan(self):
         self.clog.critical("handleShowDetailsOfScan() called")
 
+    def handleDeleteScan(self):
+        self.clog.critical("handleDeleteScan() called")
+
+        self.clog.critical("Enter scan id:")
+        scanId = int(input())
+
+        self.scan.delete(scanId)
+
+    def handleRetryScan(self):
+        self.clog.critical("handleRetryScan() called")
+
+        self.clog.critical("Enter scan id:")
+        scanId = int(input())
+
+        self.scan.retry(scanId)
+
     def handleStartNewScan(self):
         self.clog.critical("handleStartNewScan() called")
 
@@ -63,11 +81,35 @@ class MainMenu:
         scanName = input()
         self.clog.critical("Enter root path:")
         rootPath = input()
-
-        # 1. Create a scan object
-        scan = Scan()
+        self.clog.critical("Reuse hashes of unchanged files from previous scan of this path (y/n):")
+        incremental = input().strip().lower() == "y"
+        hash = self.readHashAlgorithm()
+        hashAlgorithm = hash.algorithm
+        self.clog.critical("Verify duplicate files byte by byte (y/n):")
+        verifyContent = input().strip().lower() == "y"
+        confirmHash = False
+        if not verifyContent and not hash.isCryptographic():
+            self.clog.critical(
+                "Confirm duplicates with {confirm} (Y/n):".format(confirm=Hash.CONFIRM_ALGORITHM))
+            confirmHash = input().strip().lower() != "n"
 
         # Add new scan
-        scanId = scan.insert(scanName, rootPath)
+        scanId = self.scan.insert(scanName, rootPath, incremental,
+                                  hashAlgorithm, confirmHash, verifyContent)
         self.clog.critical(
             "New scan is created with id: {scanId}".format(scanId=scanId))
+
+    def readHashAlgorithm(self):
+        """
+        Asks for hash algorithm till it is usable in this installation.
+        :return: Hash object with the algorithm set.
+        """
+        hash = Hash()
+        while True:
+            self.clog.critical("Hash algorithm ({algorithms}) [{default}]:".format(
+                algorithms=", ".join(Hash.ALGORITHMS), default=Hash.DEFAULT_ALGORITHM))
+            try:
+                hash.setAlgorithm(input().strip() or Hash.DEFAULT_ALGORITHM)
+                return hash
+            except Exception as ex:
+                self.clog.critical("{error}, please select another algorithm.".format(error=ex))
@@ -1,9 +1,12 @@
-import os
 import time
 import logging
-from core.utility import Utility
+import threading
+import traceback
 from core.sqlite_db import DB
 from core.fsobject import FsObject
+from core.duplicate_group import DuplicateGroup
+from core.hash import Hash
+from core.walker import Walker
 
 # Class to manage all scan request, it creates new request, checks for pending request
 # and tries to complete them in order of their request.
@@ -16,41 +19,101 @@ class Scan:
     SCAN_STATE_UPDATE_FOLDER_SIZE = 3
     SCAN_STATE_DUPLICATE_FOLDER = 4
     SCAN_STATE_COMPLETED = 5
+    SCAN_STATE_VERIFY_DUPLICATES = 6
+    SCAN_STATE_DUPLICATE_REPORT = 7
 
-    def __init__(self):
+    # Failed scan is tried again after RETRY_DELAY seconds, doubled with every failure. After MAX_FAILURES
+    # failed attempts it is skipped until retry() resets it.
+    RETRY_DELAY = 60
+    MAX_FAILURES = 5
+
+    def __init__(self, walkerWorkers=1, hashWorkers=1, hashDeviceWorkers=None, hashBlockSize=Hash.BLOCK_SIZE, hashMmapThreshold=Hash.MMAP_THRESHOLD,
+                 dbProfile=DB.PROFILE_BULK_INGEST):
+        """
+        :param walkerWorkers: Number of threads used to list directories during scan, 1 means serial walk.
+        :param hashWorkers: Number of threads used to compute file hashes per device, 1 means hash on calling thread.
+        Rotational disks always get a single sequential reader.
+        :param hashDeviceWorkers: Optional dict of st_dev to number of hashing threads for that device.
+        :param hashBlockSize: Size of read buffer used for hashing.
+        :param hashMmapThreshold: Files of this size or larger are hashed through mmap, None disables mmap.
+        :param dbProfile: Database tuning profile, one of DB.PROFILES.
+        """
         # Create logger
         self.clog = logging.getLogger("CORE.SCAN")
 
-        # Create utlity object
-        self.utility = Utility()
-
         # DB object
-        self.db = DB()
+        self.db = DB(dbProfile)
+
+        # Set by requestStop(), walk and hashing stop after files in flight, other states are finished.
+        self.stopEvent = threading.Event()
 
         # FS Object initialization
-        self.fsobject = FsObject(self.db)
+        self.fsobject = FsObject(
+            self.db, hashWorkers=hashWorkers, hashDeviceWorkers=hashDeviceWorkers,
+            hashBlockSize=hashBlockSize, hashMmapThreshold=hashMmapThreshold, stopEvent=self.stopEvent)
+
+        # Topmost duplicate groups report
+        self.duplicateGroup = DuplicateGroup(self.db)
 
-    def insert(self, name, rootPath):
+        # Directory tree walker
+        self.walker = Walker(walkerWorkers)
+
+        # State of the scan being processed, database statistics are dumped per state.
+        self.currentState = self.SCAN_STATE_PENDING
+
+    def requestStop(self):
+        """
+        Asks process() to stop soon, may be called from a signal handler. Walk and hash stages stop after files in
+        flight and stay the stored state of the scan, other states are finished and the next one is stored. Next
+        process() resumes from the stored state, a stopped walk starts over.
+        """
+        self.stopEvent.set()
+
+    def isStopRequested(self, scanId):
+        if not self.stopEvent.is_set():
+            return False
+
+        self.clog.critical("Scan id: %ld, Stop requested, scan resumes from state %s",
+                           scanId, self.getReadableState(self.currentState))
+        return True
+
+    def insert(self, name, rootPath, incremental=False, hashAlgorithm=Hash.DEFAULT_ALGORITHM, confirmHash=None, verifyContent=False):
         """
         Function creates a new scan entry in the databse with pending as status.
+        :param incremental: If True, content hashes of unchanged files are reused from the most
+        recent completed scan of the same root path.
+        :param hashAlgorithm: One of Hash.ALGORITHMS, stored on the scan so hashes are never mixed across algorithms.
+        :param confirmHash: If True, collisions of a non-cryptographic algorithm are confirmed with a strong hash.
+        None confirms them unless content is verified byte by byte.
+        :param verifyContent: If True, duplicate files are confirmed by comparing their content byte by byte.
+        :return: Id of the new scan.
         """
-        name = self.utility.encodeDBString(name)
-        rootPath = self.utility.encodeDBString(rootPath)
+        # Fail early for unknown or unavailable algorithm.
+        hash = Hash(algorithm=hashAlgorithm)
+
+        # Short hash collides across different files, its duplicates are confirmed unless content is compared.
+        if confirmHash is None:
+            confirmHash = not verifyContent and not hash.isCryptographic()
+        if not hash.isCryptographic() and not confirmHash and not verifyContent:
+            self.clog.warning("Duplicates by %s hash are neither confirmed nor verified, colliding files are reported as duplicates",
+                              hashAlgorithm)
 
         timestamp = int(round(time.time() * 1000))
-        query = "INSERT INTO scan(name, root_path, state, created_timestamp, modified_timestamp) \
-      VALUES (?, ?, ?, ?, ?)"
+        query = "INSERT INTO scan(name, root_path, state, created_timestamp, modified_timestamp, incremental, hash_algorithm, confirm_hash, verify_content) \
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
         params = (name, rootPath, self.SCAN_STATE_PENDING,
-                  timestamp, timestamp)
+                  timestamp, timestamp, 1 if incremental else 0, hashAlgorithm, 1 if confirmHash else 0, 1 if verifyContent else 0)
         newScanId = self.db.execInsert(query, params, True)
 
         self.clog.critical("Created a new scan with id: %d", newScanId)
+        return newScanId
 
     def process(self):
         """
         Main function that performs duplicate check for all files within root folder.
         This is heavy operation and blocks the calling thread till it gets completed.
-        If there is nothing pending, it simply returns.
+        If there is nothing pending, it simply returns. After requestStop() it returns soon, see requestStop().
+        A scan that raises an exception is recorded as failed and the next scan is processed, see recordFailure().
         """
 
         # 0. Build state machine (SM)
@@ -58,55 +121,142 @@ class Scan:
         sm = {
             self.SCAN_STATE_PENDING: self.handlePendingState,
             self.SCAN_STATE_SCANNED: self.handleScannedState,
+            self.SCAN_STATE_VERIFY_DUPLICATES: self.handleVerifyDuplicatesState,
             self.SCAN_STATE_UPDATE_FOLDER_SIZE: self.handleUpdateFolderSizeState,
             self.SCAN_STATE_DUPLICATE_FOLDER: self.handleDuplicateFolderState,
+            self.SCAN_STATE_DUPLICATE_REPORT: self.handleDuplicateReportState,
             self.SCAN_STATE_COMPLETED: self.handleCompletedState
         }
 
-        # 1. Get pending scans
-        query = "SELECT id, state, name, root_path FROM scan WHERE state != ?"
-        params = ("{state}".format(state=self.SCAN_STATE_COMPLETED))
+        # 1. Get pending scans, a failed scan waits for its retry time.
+        query = "SELECT id, state, name, root_path, incremental, hash_algorithm, confirm_hash, verify_content FROM scan " \
+            "WHERE state != ? AND failure_count < ? AND (retry_timestamp IS NULL OR retry_timestamp <= ?)"
+        params = (self.SCAN_STATE_COMPLETED, self.MAX_FAILURES,
+                  int(round(time.time() * 1000)))
         pendingScans = self.db.fetchAll(query, params)
         for pScan in pendingScans:
+            if self.stopEvent.is_set():
+                break
+
             self.clog.critical(
                 "Found pending scan: {id} => {state} '{name}' '{path}'".format(id=pScan[0], state=pScan[1], name=pScan[2], path=pScan[3]))
 
-            # 2. Set scan id for FS object.
-            self.fsobject.setScanId(pScan[0])
-
-            # Based on status of the scan, perform action.
-            handler = sm.get(pScan[1], lambda: "Invalid state")
-            handler(pScan)
+            try:
+                # 2. Set scan id and hash algorithm for FS object, objects of the scan may be in its own file.
+                self.db.useScan(pScan[0])
+                self.fsobject.setScanId(pScan[0], pScan[5], pScan[6])
+
+                # Based on status of the scan, perform action.
+                self.currentState = pScan[1]
+                self.db.resetStatistics()
+                handler = sm.get(pScan[1], lambda: "Invalid state")
+                handler(pScan)
+            except Exception:
+                # 3. A failing scan does not block the scans after it.
+                self.recordFailure(pScan[0])
+
+    def recordFailure(self, scanId):
+        """
+        Records failed attempt of a scan from within the except block of its exception. The scan resumes from its stored
+        state after RETRY_DELAY seconds doubled with every failure, after MAX_FAILURES attempts it is skipped.
+        """
+        self.clog.exception("Scan id: %ld, Failed in state %s",
+                            scanId, self.getReadableState(self.currentState))
+        self.db.rollback()
+
+        row = self.db.fetchAll("SELECT failure_count FROM scan WHERE id = ?", (scanId, ))
+        if not row:
+            return
+
+        failures = (row[0][0] or 0) + 1
+        retryDelay = self.RETRY_DELAY * 2 ** (failures - 1)
+        query = "UPDATE scan SET failure_count = ?, last_error = ?, retry_timestamp = ? WHERE id = ?"
+        self.db.execDelete(query, (failures, traceback.format_exc(limit=-1).strip(),
+                                   int(round((time.time() + retryDelay) * 1000)), scanId), True)
+
+        if failures >= self.MAX_FAILURES:
+            self.clog.critical("Scan id: %ld, Failed %d times, skipped until it is retried from the main menu",
+                               scanId, failures)
+        else:
+            self.clog.critical("Scan id: %ld, Failed %d of %d times, next attempt in %ds",
+                               scanId, failures, self.MAX_FAILURES, retryDelay)
+
+    def setState(self, scanId, state):
+        # Stage that ends here dumps its database statistics.
+        self.logStageStatistics(scanId)
+        self.currentState = state
+
+        query = "UPDATE scan SET state = ? WHERE id = ?"
+        self.db.execDelete(query, (state, scanId), True)
+
+    def logStageStatistics(self, scanId):
+        self.db.logStatistics("Scan id: {id}, Database statistics of {stage}".format(
+            id=scanId, stage=self.getReadableState(self.currentState)))
 
     def handlePendingState(self, scan):
         # 2.a Scan is in PENDING state
 
-        # 2.a.1 Remove all file enteries for given scan from 'file' table.
-        self.fsobject.deleteAllForScanId()
-
-        # 2.a.2 Scan scanning all files and adding it to 'file' table.
-        self.scanObjectsAndAdd(scan[0], scan[3])
+        # 2.a.1 Remove all file enteries for given scan from 'file' table, a scan file is replaced by an empty one.
+        if self.db.dropScan(scan[0]):
+            self.db.useScan(scan[0])
+        else:
+            self.fsobject.deleteAllForScanId()
+            self.duplicateGroup.deleteAllForScanId(scan[0])
+
+        # 2.a.2 Scan scanning all files and adding it to 'file' table, without maintaining indexes during bulk insert
+        # unless the table is shared with other scans.
+        if not self.db.hasOtherScanObjects(scan[0]):
+            self.db.dropFsobjectIndexes()
+        try:
+            walked = self.scanObjectsAndAdd(scan[0], scan[3])
+        finally:
+            self.db.createFsobjectIndexes()
+
+        # Stopped walk starts over on next process().
+        if not walked and self.isStopRequested(scan[0]):
+            return
+
+        # 2.a.3 Incremental scan reuses hashes of unchanged files from previous scan.
+        if scan[4]:
+            self.reuseHashesFromPreviousScan(scan)
 
         # 2.a.4 Call next state handler
         self.handleScannedState(scan)
 
     def handleScannedState(self, scan):
         # 2.b Scan is in SCANNED state
-        query = "UPDATE scan SET state = {state} WHERE id = {id}".format(
-            id=scan[0], state=self.SCAN_STATE_SCANNED)
-        self.db.execDelete(query, None, True)
+        self.setState(scan[0], self.SCAN_STATE_SCANNED)
+        if self.isStopRequested(scan[0]):
+            return
 
-        # 2.b.1 Identify and mark duplicate files
+        # 2.b.1 Identify and mark duplicate files, stopped hashing continues on next process().
         self.fsobject.markDuplicateFiles()
+        if self.isStopRequested(scan[0]):
+            return
 
         # 2.b.2 call next state handler
+        self.handleVerifyDuplicatesState(scan)
+
+    def handleVerifyDuplicatesState(self, scan):
+        # 2.b' Scan is in VERIFY_DUPLICATES state
+        self.setState(scan[0], self.SCAN_STATE_VERIFY_DUPLICATES)
+        if self.isStopRequested(scan[0]):
+            return
+
+        # 2.b'.1 Compare content of duplicate files byte by byte, if requested for the scan.
+        if scan[7]:
+            self.fsobject.verifyDuplicateFiles()
+            if self.isStopRequested(scan[0]):
+                return
+
+        # 2.b'.2 call next state handler
         self.handleUpdateFolderSizeState(scan)
 
     def handleUpdateFolderSizeState(self, scan):
         # 2.c Scan is in UPDATE_FOLDER_SIZE state
-        query = "UPDATE scan SET state = {state} WHERE id = {id}".format(
-            id=scan[0], state=self.SCAN_STATE_UPDATE_FOLDER_SIZE)
-        self.db.execDelete(query, None, True)
+        self.setState(scan[0], self.SCAN_STATE_UPDATE_FOLDER_SIZE)
+        if self.isStopRequested(scan[0]):
+            return
 
         # 2.c.1 Update all folder size by summing up the size of the folder and files it has.
         self.fsobject.updateFolderSize()
@@ -116,66 +266,147 @@ class Scan:
 
     def handleDuplicateFolderState(self, scan):
         # 2.d Scan is in DUPLICATE FOLDER state
-        query = "UPDATE scan SET state = {state} WHERE id = {id}".format(
-            id=scan[0], state=self.SCAN_STATE_DUPLICATE_FOLDER)
-        self.db.execDelete(query, None, True)
+        self.setState(scan[0], self.SCAN_STATE_DUPLICATE_FOLDER)
+        if self.isStopRequested(scan[0]):
+            return
 
         # 2.d.1 Update all folder as duplicate, if all its files and sub folders are duplicate
         self.fsobject.markFolderAsDuplicate()
 
         # 2.d.2 Call next state handler
+        self.handleDuplicateReportState(scan)
+
+    def handleDuplicateReportState(self, scan):
+        # 2.e Scan is in DUPLICATE REPORT state
+        self.setState(scan[0], self.SCAN_STATE_DUPLICATE_REPORT)
+        if self.isStopRequested(scan[0]):
+            return
+
+        # 2.e.1 Keep only topmost duplicate groups, objects below a duplicate folder are collapsed.
+        self.duplicateGroup.build(
+            scan[0], self.fsobject.getFolderPrefixes())
+
+        # 2.e.2 Call next state handler
         self.handleCompletedState(scan)
 
     def handleCompletedState(self, scan):
-        # 2.d Scan state is COMPLETED
-        query = "UPDATE scan SET state = {state} WHERE id = {id}".format(
-            id=scan[0], state=self.SCAN_STATE_COMPLETED)
-        self.db.execDelete(query, None, True)
+        # 2.f Scan state is COMPLETED
+        self.setState(scan[0], self.SCAN_STATE_COMPLETED)
+
+        # 2.f.1 Completed scan forgets its failed attempts.
+        query = "UPDATE scan SET failure_count = 0, retry_timestamp = NULL WHERE id = ? AND failure_count > 0"
+        self.db.execDelete(query, (scan[0], ), True)
+
+        # 2.f.2 Keep hash cache within its age and size limits.
+        self.fsobject.hashCache.evict()
+        self.logStageStatistics(scan[0])
 
     def scanObjectsAndAdd(self, scanId, rootPath):
+        """
+        Walks the tree of the scan and inserts all folders and files.
+        :return: False if the walk was stopped by requestStop().
+        """
         totalFolders = 0
         totalFiles = 0
         totalSizeInBytes = 0
+        startTime = time.perf_counter()
 
         # Insert main path as root.
         totalFolders += 1
+        root = self.walker.statRoot(rootPath)
         self.fsobject.insert(self.fsobject.FSOBJECT_TYPE_FOLDER,
-                             None, rootPath, -1, True)
+                             None, root.name, -1, root.mtimeNs, root.inode, root.device)
+
+        for parent, folders, files in self.walker.walk(rootPath):
+            # Stopped walk keeps no partial counts, its rows are removed when it starts over.
+            if self.stopEvent.is_set():
+                self.fsobject.flushInserts()
+                return False
 
-        for parent, dirs_list, files_list in os.walk(rootPath):
             # Add all directory objects.
-            for d in dirs_list:
+            for d in folders:
                 totalFolders += 1
                 self.fsobject.insert(
-                    self.fsobject.FSOBJECT_TYPE_FOLDER, parent, d, -1, True)
+                    self.fsobject.FSOBJECT_TYPE_FOLDER, parent, d.name, -1, d.mtimeNs, d.inode, d.device)
 
-            # Add all file objects.
-            for f in files_list:
+            # Add all file objects, size and stat fields come from the directory listing.
+            for f in files:
                 totalFiles += 1
-                filePath = os.path.join(parent, f)
-                fileSize = os.path.getsize(filePath)
                 self.fsobject.insert(
-                    self.fsobject.FSOBJECT_TYPE_FILE, parent, f, fileSize, False)
+                    self.fsobject.FSOBJECT_TYPE_FILE, parent, f.name, f.sizeInBytes, f.mtimeNs, f.inode, f.device)
 
-                totalSizeInBytes += fileSize
+                totalSizeInBytes += f.sizeInBytes
 
-            # Commit all file enteries to db.
-            self.fsobject.commitTransactions()
+        # Write remaining buffered enteries to db.
+        self.fsobject.flushInserts()
+        elapsed = time.perf_counter() - startTime
 
         # Update folder and files count, total size to scan
-        query = "UPDATE scan SET folder_count = {totalFolders}, file_count = {totalFiles}, total_size_in_bytes = {totalSizeInBytes} WHERE id = {id}".format(
-            id=scanId, totalFolders=totalFolders, totalFiles=totalFiles, totalSizeInBytes=totalSizeInBytes)
-        self.db.execDelete(query, None, True)
+        query = "UPDATE scan SET folder_count = ?, file_count = ?, total_size_in_bytes = ? WHERE id = ?"
+        self.db.execDelete(
+            query, (totalFolders, totalFiles, totalSizeInBytes, scanId), True)
 
         self.clog.critical(
             "Scan id: %ld, Added total folders: %d and files: %d", scanId, totalFolders, totalFiles)
+        self.clog.critical(
+            "Scan id: %ld, Walked %d objects in %.2fs (%d rows/sec), database insert rate: %d rows/sec",
+            scanId, totalFolders + totalFiles, elapsed, (totalFolders + totalFiles) / elapsed if elapsed else 0, self.fsobject.getInsertRate())
+        return True
+
+    def reuseHashesFromPreviousScan(self, scan):
+        """
+        Finds most recent completed scan of the same root path and hash algorithm and copies content hash of every
+        file whose path, size, mtime and inode did not change since that scan. Confirm and class hashes of that scan
+        are not copied, see FsObject.copyHashesFromScan().
+        """
+        query = "SELECT id FROM scan WHERE root_path = ? AND state = ? AND hash_algorithm = ? AND id != ? ORDER BY id DESC LIMIT 0,1"
+        row = self.db.fetchAll(
+            query, (scan[3], self.SCAN_STATE_COMPLETED, scan[5], scan[0]))
+        if not row:
+            self.clog.critical(
+                "Scan id: %ld, No completed %s scan of '%s' found, hashing all files", scan[0], scan[5], scan[3])
+            return
+
+        baseScanId = row[0][0]
+        query = "UPDATE scan SET base_scan_id = ? WHERE id = ?"
+        self.db.execDelete(query, (baseScanId, scan[0]), True)
+
+        reused = self.fsobject.copyHashesFromScan(baseScanId)
+        self.clog.critical(
+            "Scan id: %ld, Reused %d content hashes from scan id: %ld", scan[0], reused, baseScanId)
+
+    def delete(self, scanId):
+        """
+        Deletes a scan with its objects and duplicate groups. In per scan layout only the scan file is removed.
+        """
+        if not self.db.dropScan(scanId):
+            self.fsobject.deleteAllForScanId(scanId)
+            self.duplicateGroup.deleteAllForScanId(scanId)
+
+        self.db.execDelete("DELETE FROM scan WHERE id = ?", (scanId, ), True)
+        self.clog.critical("Deleted scan with id: %d", scanId)
+
+    def retry(self, scanId):
+        """
+        Clears failed attempts of a scan, so next process() tries it again at once from its stored state.
+        :return: True if the scan exists.
+        """
+        query = "UPDATE scan SET failure_count = 0, retry_timestamp = NULL WHERE id = ?"
+        if not self.db.execDelete(query, (scanId, ), True):
+            self.clog.critical("No scan with id: %d", scanId)
+            return False
+
+        self.clog.critical("Scan with id: %d is retried by next process", scanId)
+        return True
 
     def getReadableState(self, state):
         d = {
             self.SCAN_STATE_PENDING: "PENDING",
             self.SCAN_STATE_SCANNED: "OBJECT SCAN COMPLETE",
+            self.SCAN_STATE_VERIFY_DUPLICATES: "VERIFYING DUPLICATE FILES",
             self.SCAN_STATE_UPDATE_FOLDER_SIZE: "FOLDER SIZE UPDATED",
             self.SCAN_STATE_DUPLICATE_FOLDER: "MARKING DUPLICATE FOLDER",
+            self.SCAN_STATE_DUPLICATE_REPORT: "BUILDING DUPLICATE REPORT",
             self.SCAN_STATE_COMPLETED: "COMPLETED"
         }
 
@@ -1,25 +1,214 @@
-import logging
 import os
+import time
+import bisect
+import logging
 import sqlite3
+from core.hash import Hash
 
 
 class DB:
-    def __init__(self):
+    # Secondary indexes of fsobject table, name to columns. Every stage of a scan filters by one of
+    # these. They are dropped while a scan bulk inserts its objects into a table of its own and created
+    # again after it, see hasOtherScanObjects().
+    FSOBJECT_INDEXES = {
+        "fsobject_scan_parent_name": "scan_id, parent_id, name",
+        "fsobject_scan_type_size": "scan_id, type, size_in_bytes",
+        "fsobject_scan_type_state_prefix_size": "scan_id, type, state, hash_prefix, size_in_bytes"
+    }
+
+    # Connection tuning profiles, every profile uses WAL so the web UI can read while a scan writes.
+    PROFILE_BULK_INGEST = "bulk-ingest"
+    PROFILE_SAFE = "safe"
+    PROFILE_READ_ONLY_UI = "read-only-ui"
+
+    # Pragmas of every profile, applied in order when connection is opened. Cache size is in KiB when
+    # negative, temp store 1 is file and 2 is memory.
+    PROFILES = {
+        # Scan pipeline: large cache and mmap, WAL with synchronous NORMAL does not sync on every
+        # commit but can not corrupt the database, last commits may be lost on power failure.
+        PROFILE_BULK_INGEST: [("journal_mode", "WAL"), ("synchronous", "NORMAL"), ("cache_size", -262144),
+                              ("mmap_size", 1024 * 1024 * 1024), ("temp_store", 2)],
+        # Every commit is durable.
+        PROFILE_SAFE: [("journal_mode", "WAL"), ("synchronous", "FULL"), ("cache_size", -65536),
+                       ("mmap_size", 256 * 1024 * 1024), ("temp_store", 1)],
+        # Web UI only reads, writes are rejected by the connection.
+        PROFILE_READ_ONLY_UI: [("journal_mode", "WAL"), ("synchronous", "NORMAL"), ("cache_size", -65536),
+                               ("mmap_size", 256 * 1024 * 1024), ("temp_store", 2), ("query_only", 1)]
+    }
+
+    # Prepared statements kept per connection. Every query binds its values, so each one is parsed
+    # once and the whole pipeline fits in the cache.
+    STATEMENT_CACHE_SIZE = 256
+
+    # Schema version kept in PRAGMA user_version.
+    SCHEMA_VERSION = 7
+
+    # Quote substitutes in names and paths written before version 1, when SQL was built with str.format.
+    LEGACY_SINGLE_QUOTE = "_@$1Q$@_"
+    LEGACY_DOUBLE_QUOTE = "_@$2Q$@_"
+
+    # Rows migrated per transaction.
+    MIGRATION_BATCH_SIZE = 100000
+
+    # Ordered schema migrations (version, description, method). A method upgrades tables of one database, main or
+    # an attached scan file, from the previous version. Methods check tables and columns they change, so they can
+    # run again after an interrupted upgrade and skip tables the database does not have.
+    MIGRATIONS = [
+        (1, "Add columns of unversioned databases and decode quote substitutes", "upgradeUnversionedTables"),
+        (2, "Store object names instead of full paths", "normalizePaths"),
+        (3, "Rank duplicate groups by wasted bytes", "rankDuplicateGroups"),
+        (4, "Store content hashes as bytes with integer prefix", "storeBinaryHashes"),
+        (5, "Group content hashes by size", "addSizeToPrefixIndex"),
+        (6, "Record failed scan attempts", "addScanFailureColumns"),
+        (7, "Keep hashes of the scan algorithm for incremental scans", "addAlgorithmHashColumn")
+    ]
+
+    # Upper bounds of latency histogram buckets in seconds, 1 us to about 2 minutes in steps of 2x.
+    LATENCY_BUCKETS = [0.000001 * 2 ** i for i in range(28)]
+
+    # Statements listed per statistics summary, slowest by total time first.
+    STATISTICS_TOP = 10
+
+    # Environment variable that enables full SQL tracing when set to 1.
+    TRACE_ENVIRONMENT = "FINDUP_DB_TRACE"
+
+    # Environment variable that creates a new database with per scan files when set to 1.
+    PER_SCAN_FILES_ENVIRONMENT = "FINDUP_PER_SCAN_FILES"
+
+    # Folder of the database files.
+    DB_FOLDER = "./db"
+
+    # Objects and duplicate groups of a scan in per scan layout, attached as schema "scan_<id>".
+    SCAN_FILE = "scan_{scanId}.db"
+
+    # Profile pragmas that are set per attached database, the others apply to whole connection.
+    SCHEMA_PRAGMAS = ("journal_mode", "synchronous", "cache_size", "mmap_size")
+
+    def __init__(self, profile=PROFILE_SAFE, trace=None):
         """
         Important contructor that opens database connection and also creates
         required tables if db is created for the first time.
+        :param profile: One of PROFILES, sets journal, sync, cache, mmap and temp store of the connection.
+        :param trace: If True, every executed statement is logged with its values. None reads TRACE_ENVIRONMENT.
         """
         self.clog = logging.getLogger("CORE.DB")
+        self.traceLog = logging.getLogger("CORE.DB.TRACE")
+
+        # Per statement counters, see record().
+        self.resetStatistics()
+
+        if profile not in self.PROFILES:
+            raise Exception("Unknown database profile: {profile}".format(
+                profile=profile))
 
         # Create db folder if not exists.
-        dbFolder = "./db"
-        os.makedirs(name=dbFolder, exist_ok=True)
+        os.makedirs(name=self.DB_FOLDER, exist_ok=True)
 
         # Opens / creates a new database file.
-        dbFile = "{dbFolder}/findup.db".format(dbFolder=dbFolder)
-        self.conn = sqlite3.connect(dbFile)
+        dbFile = "{dbFolder}/findup.db".format(dbFolder=self.DB_FOLDER)
+        self.conn = sqlite3.connect(
+            dbFile, cached_statements=self.STATEMENT_CACHE_SIZE)
+        self.applyProfile(profile)
+
+        # Integer prefix of a hash for queries that copy hashes, see Hash.getPrefix().
+        self.conn.create_function(
+            "hash_to_prefix", 1, Hash().getPrefix, deterministic=True)
+
+        # Layout of an existing database, main database without fsobject table keeps only the scan catalog
+        # and every scan has its own file. Schema of the scan unqualified table names resolve to.
+        self.perScanFiles = self.hasTable("scan") and not self.hasTable("fsobject")
+        self.scanSchema = "main"
+        self.attachedScans = []
+
+        if trace is None:
+            trace = os.environ.get(self.TRACE_ENVIRONMENT) == "1"
+        self.setTrace(trace)
+
+    def setTrace(self, enabled):
+        """
+        Logs every statement executed on the connection with bound values expanded, for debugging only.
+        """
+        self.conn.set_trace_callback(self.traceLog.info if enabled else None)
+
+    def resetStatistics(self):
+        self.statistics = {}
+
+    def record(self, query, seconds, rows):
+        """
+        Adds one execution to counters of the statement: [count, total seconds, rows, latency histogram].
+        """
+        counters = self.statistics.get(query)
+        if counters is None:
+            counters = self.statistics[query] = [
+                0, 0.0, 0, [0] * (len(self.LATENCY_BUCKETS) + 1)]
+
+        counters[0] += 1
+        counters[1] += seconds
+        counters[2] += rows
+        counters[3][bisect.bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+
+    def getPercentile(self, histogram, count, percentile):
+        """
+        :return: Upper bound in seconds of the bucket that holds the percentile.
+        """
+        rank = count * percentile / 100.0
+        seen = 0
+        for i, bucketCount in enumerate(histogram):
+            seen += bucketCount
+            if seen >= rank:
+                break
+
+        return self.LATENCY_BUCKETS[min(i, len(self.LATENCY_BUCKETS) - 1)]
+
+    def logStatistics(self, title):
+        """
+        Logs totals and the slowest statements since last reset, then resets counters.
+        """
+        totalCount = sum(c[0] for c in self.statistics.values())
+        totalSeconds = sum(c[1] for c in self.statistics.values())
+        self.clog.critical("%s: %d statements (%d distinct) in %.3fs",
+                           title, totalCount, len(self.statistics), totalSeconds)
+
+        slowest = sorted(self.statistics.items(),
+                         key=lambda item: item[1][1], reverse=True)
+        for query, (count, seconds, rows, histogram) in slowest[:self.STATISTICS_TOP]:
+            self.clog.info("    %6d x %8.3fs p50 <= %.6fs p99 <= %.6fs rows %d: %s", count, seconds,
+                           self.getPercentile(histogram, count, 50), self.getPercentile(histogram, count, 99),
+                           rows, " ".join(query.split())[:120])
+
+        self.resetStatistics()
+
+    def applyProfile(self, profile):
+        """
+        Applies pragmas of the profile to the open connection.
+        """
+        for pragma, value in self.PROFILES[profile]:
+            self.conn.execute("PRAGMA {pragma} = {value}".format(
+                pragma=pragma, value=value))
+
+        self.profile = profile
+        self.clog.info("Opened database with profile: %s", profile)
+
+    def createDbs(self, perScanFiles=None):
+        """
+        Creates missing tables and upgrades an existing database.
+        :param perScanFiles: If True, a new database keeps only the scan catalog and every scan is stored in its
+        own file, see useScan(). Layout of an existing database does not change. None reads PER_SCAN_FILES_ENVIRONMENT.
+        """
+        if perScanFiles is None:
+            perScanFiles = os.environ.get(self.PER_SCAN_FILES_ENVIRONMENT) == "1"
+        if not self.hasTable("scan"):
+            self.perScanFiles = bool(perScanFiles)
+        elif bool(perScanFiles) != self.perScanFiles:
+            self.clog.warning("Database already uses %s, layout is not changed",
+                              "per scan files" if self.perScanFiles else "a shared fsobject table")
+
+        # Tables of an existing database are upgraded before missing ones are created, so every table
+        # created below already has columns of the current version.
+        newDatabase = not self.hasTable("scan")
+        if not newDatabase:
+            self.migrate()
 
-    def createDbs(self):
         # Create scan table if not exists.
         query = '''
             CREATE TABLE IF NOT EXISTS "scan" (
@@ -31,26 +220,517 @@ class DB:
                 "file_count"            INTEGER,
                 "total_size_in_bytes"   INTEGER,
                 "created_timestamp"     INTEGER,
-                "modified_timestamp"	INTEGER
+                "modified_timestamp"	INTEGER,
+                "incremental"           INTEGER DEFAULT 0,
+                "base_scan_id"          INTEGER,
+                "hash_algorithm"        TEXT DEFAULT 'sha256',
+                "confirm_hash"          INTEGER DEFAULT 0,
+                "verify_content"        INTEGER DEFAULT 0,
+                "failure_count"         INTEGER DEFAULT 0,
+                "last_error"            TEXT,
+                "retry_timestamp"       INTEGER
             );
         '''
         self.execInsert(query, None, True)
 
+        # Content hash cache shared by all scans.
         query = '''
-            CREATE TABLE IF NOT EXISTS "fsobject" (
+            CREATE TABLE IF NOT EXISTS "hash_cache" (
+                "id"                    INTEGER PRIMARY KEY,
+                "device"                INTEGER,
+                "inode"                 INTEGER,
+                "size_in_bytes"         INTEGER,
+                "mtime_ns"              INTEGER,
+                "algorithm"             TEXT,
+                "content_hash"          BLOB,
+                "created_timestamp"     INTEGER,
+                "accessed_timestamp"    INTEGER,
+                UNIQUE ("device", "inode", "size_in_bytes", "mtime_ns", "algorithm")
+            );
+        '''
+        self.execInsert(query, None, True)
+        self.execInsert(
+            "CREATE INDEX IF NOT EXISTS hash_cache_accessed ON hash_cache(accessed_timestamp)", None, True)
+
+        if not self.perScanFiles:
+            self.createScanTables("main")
+            self.createScanIndexes("main")
+
+        if newDatabase:
+            self.setSchemaVersion(self.SCHEMA_VERSION)
+        elif self.perScanFiles:
+            self.migrateScanFiles()
+
+    def createScanTables(self, schema):
+        """
+        Creates tables that hold objects and duplicate groups of scans.
+        :param schema: "main" for shared layout, schema of the scan file otherwise.
+        """
+        query = '''
+            CREATE TABLE IF NOT EXISTS "{schema}"."fsobject" (
                 "id"                    INTEGER PRIMARY KEY AUTOINCREMENT,
                 "scan_id"               INTEGER,
                 "parent_id"             INTEGER,
                 "type"                  INTEGER,
-                "full_path"             TEXT,
+                "name"                  TEXT,
                 "state"                 INTEGER,
                 "size_in_bytes"         INTEGER,
-                "content_hash"          TEXT,
+                "content_hash"          BLOB,
                 "created_timestamp"     INTEGER,
-                "modified_timestamp"	INTEGER
+                "modified_timestamp"	INTEGER,
+                "mtime_ns"              INTEGER,
+                "inode"                 INTEGER,
+                "device"                INTEGER,
+                "partial_hash"          BLOB,
+                "hash_prefix"           INTEGER,
+                "algorithm_hash"        BLOB
+            );
+        '''
+        self.execInsert(query.format(schema=schema), None, True)
+
+        # Topmost duplicate groups of a scan and their members.
+        query = '''
+            CREATE TABLE IF NOT EXISTS "{schema}"."dup_group" (
+                "id"                    INTEGER PRIMARY KEY,
+                "scan_id"               INTEGER,
+                "content_hash"          BLOB,
+                "type"                  INTEGER,
+                "size_in_bytes"         INTEGER,
+                "member_count"          INTEGER,
+                "wasted_bytes"          INTEGER,
+                "representative_path"   TEXT
+            );
+        '''
+        self.execInsert(query.format(schema=schema), None, True)
+
+        query = '''
+            CREATE TABLE IF NOT EXISTS "{schema}"."dup_group_member" (
+                "group_id"              INTEGER,
+                "fsobject_id"           INTEGER
             );
         '''
+        self.execInsert(query.format(schema=schema), None, True)
+
+    def createScanIndexes(self, schema):
+        """
+        Creates indexes of tables created by createScanTables().
+        """
+        # Groups of a scan are read in wasted bytes order a page at a time, see DuplicateGroup.getGroups().
+        self.execInsert(
+            "CREATE INDEX IF NOT EXISTS \"{schema}\".dup_group_scan_wasted ON dup_group(scan_id, wasted_bytes, id)".format(schema=schema), None, True)
+        self.execInsert(
+            "CREATE INDEX IF NOT EXISTS \"{schema}\".dup_group_member_group_object ON dup_group_member(group_id, fsobject_id)".format(schema=schema), None, True)
+
+        self.createFsobjectIndexes(schema=schema)
+
+    def getScanFile(self, scanId):
+        return os.path.join(self.DB_FOLDER, self.SCAN_FILE.format(scanId=scanId))
+
+    def hasScanFile(self, scanId):
+        """
+        :return: False if objects of the scan are stored in a file of its own that does not exist, for example
+        while the scan is pending. Always True for shared layout.
+        """
+        return not self.perScanFiles or os.path.exists(self.getScanFile(scanId))
+
+    def useScan(self, scanId, create=True):
+        """
+        Makes fsobject and duplicate group tables of the scan the ones unqualified names refer to. In per scan
+        layout every other scan file is detached and file of the scan is attached. Nothing to do for shared layout.
+        :param create: If True, missing file of the scan is created.
+        """
+        if not self.perScanFiles:
+            return
+
+        for attachedId in list(self.attachedScans):
+            self.detachScan(attachedId)
+        self.scanSchema = self.attachScan(scanId, create)
+
+    def attachScan(self, scanId, create=False):
+        """
+        Attaches file of a scan for queries across scans, SQLite resolves unqualified table names to the
+        earliest attached file so the scan set by useScan() keeps that role.
+        :param create: If True, missing file is created with empty tables, otherwise it is an error.
+        :return: Schema that qualifies tables of the scan.
+        """
+        if not self.perScanFiles:
+            return "main"
+
+        schema = "scan_{scanId}".format(scanId=int(scanId))
+        if scanId in self.attachedScans:
+            return schema
+
+        scanFile = self.getScanFile(scanId)
+        if not create and not os.path.exists(scanFile):
+            raise Exception("Missing file of scan id: {scanId}, {scanFile}".format(
+                scanId=scanId, scanFile=scanFile))
+
+        # Attach is not allowed inside a transaction.
+        self.commit()
+        self.execInsert("ATTACH DATABASE ? AS \"{schema}\"".format(
+            schema=schema), (scanFile, ), False)
+        self.attachedScans.append(scanId)
+        for pragma, value in self.PROFILES[self.profile]:
+            if pragma in self.SCHEMA_PRAGMAS:
+                self.conn.execute("PRAGMA \"{schema}\".{pragma} = {value}".format(
+                    schema=schema, pragma=pragma, value=value))
+
+        if create and not self.hasTable("fsobject", schema):
+            self.createScanTables(schema)
+            self.createScanIndexes(schema)
+            self.setSchemaVersion(self.SCHEMA_VERSION, schema)
+
+        return schema
+
+    def detachScan(self, scanId):
+        if scanId not in self.attachedScans:
+            return
+
+        self.commit()
+        self.execDelete("DETACH DATABASE \"scan_{scanId}\"".format(
+            scanId=int(scanId)), None, False)
+        self.attachedScans.remove(scanId)
+        if not self.attachedScans:
+            self.scanSchema = "main"
+
+    def dropScan(self, scanId):
+        """
+        Removes objects and duplicate groups of a scan in per scan layout by deleting its file.
+        :return: False for shared layout, rows have to be deleted by caller.
+        """
+        if not self.perScanFiles:
+            return False
+
+        self.detachScan(scanId)
+        scanFile = self.getScanFile(scanId)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(scanFile + suffix):
+                os.remove(scanFile + suffix)
+
+        self.clog.info("Deleted file of scan id: %d", scanId)
+        return True
+
+    def getSchemaVersion(self, schema="main"):
+        return self.fetchAll("PRAGMA \"{schema}\".user_version".format(schema=schema), None)[0][0]
+
+    def setSchemaVersion(self, version, schema="main"):
+        self.execInsert("PRAGMA \"{schema}\".user_version = {version}".format(
+            schema=schema, version=int(version)), None, False)
+        self.commit()
+
+    def migrate(self, schema="main"):
+        """
+        Applies every migration of MIGRATIONS newer than version of the database in order. Version is recorded
+        after each migration, so an interrupted upgrade continues with the migration it stopped in.
+        :param schema: "main" or schema of an attached scan file.
+        """
+        version = self.getSchemaVersion(schema)
+        if version > self.SCHEMA_VERSION:
+            raise Exception("Database {schema} has schema version {version}, newer than supported version {supported}".format(
+                schema=schema, version=version, supported=self.SCHEMA_VERSION))
+
+        pending = [migration for migration in self.MIGRATIONS if migration[0] > version]
+        if not pending:
+            return
+
+        start = time.perf_counter()
+        for toVersion, description, method in pending:
+            self.clog.warning("Migrating %s to version %d of %d: %s",
+                              schema, toVersion, self.SCHEMA_VERSION, description)
+            getattr(self, method)(schema)
+            self.setSchemaVersion(toVersion, schema)
+
+        self.clog.warning("Migrated %s from version %d to %d in %.1fs",
+                          schema, version, self.SCHEMA_VERSION, time.perf_counter() - start)
+
+    def migrateScanFiles(self):
+        """
+        Migrates file of every scan in the catalog that was written by an older version, per scan layout only.
+        """
+        for (scanId, ) in self.fetchAll("SELECT id FROM scan ORDER BY id", None):
+            if not os.path.exists(self.getScanFile(scanId)):
+                continue
+
+            schema = self.attachScan(scanId)
+            try:
+                self.migrate(schema)
+                self.createScanIndexes(schema)
+            finally:
+                self.detachScan(scanId)
+
+    def updateInBatches(self, description, schema, table, query, params=()):
+        """
+        Runs an update over id ranges of MIGRATION_BATCH_SIZE rows of a table, one transaction each,
+        and logs progress after every range.
+        :param query: Update filtered by "id BETWEEN ? AND ?", bounds of the range are bound after params.
+        :return: Number of rows updated.
+        """
+        minId, maxId = self.fetchAll("SELECT MIN(id), MAX(id) FROM \"{schema}\".\"{table}\"".format(
+            schema=schema, table=table), None)[0]
+        if minId is None:
+            return 0
+
+        start = time.perf_counter()
+        updated = 0
+        for rangeStart in range(minId, maxId + 1, self.MIGRATION_BATCH_SIZE):
+            rangeEnd = rangeStart + self.MIGRATION_BATCH_SIZE - 1
+            updated += self.execDelete(query,
+                                       tuple(params) + (rangeStart, rangeEnd), True)
+            done = min(rangeEnd, maxId) - minId + 1
+            seconds = time.perf_counter() - start
+            self.clog.warning("%s: %d%% done, %d rows updated, %.0f rows/sec", description,
+                              100 * done // (maxId - minId + 1), updated, done / seconds if seconds > 0 else 0)
+
+        return updated
+
+    def upgradeUnversionedTables(self, schema):
+        """
+        Adds columns introduced before versions were recorded and decodes quote substitutes.
+        Hash cache created before hash algorithms were selectable is keyed without algorithm so it is dropped.
+        """
+        if self.hasTable("scan", schema):
+            # Incremental scan columns, older scans were always hashed with sha256.
+            self.addColumnIfMissing("scan", "incremental", "INTEGER DEFAULT 0", schema)
+            self.addColumnIfMissing("scan", "base_scan_id", "INTEGER", schema)
+            self.addColumnIfMissing("scan", "hash_algorithm", "TEXT DEFAULT 'sha256'", schema)
+            self.addColumnIfMissing("scan", "confirm_hash", "INTEGER DEFAULT 0", schema)
+            self.addColumnIfMissing("scan", "verify_content", "INTEGER DEFAULT 0", schema)
+
+        if self.hasTable("hash_cache", schema) and not self.hasColumn("hash_cache", "algorithm", schema):
+            self.clog.warning("Dropping hash cache without algorithm column")
+            self.execDelete("DROP TABLE \"{schema}\".hash_cache".format(
+                schema=schema), None, True)
+
+        if self.hasTable("fsobject", schema):
+            # Stat columns of incremental scans.
+            self.addColumnIfMissing("fsobject", "mtime_ns", "INTEGER", schema)
+            self.addColumnIfMissing("fsobject", "inode", "INTEGER", schema)
+            self.addColumnIfMissing("fsobject", "device", "INTEGER", schema)
+            self.addColumnIfMissing("fsobject", "partial_hash", "TEXT DEFAULT ''", schema)
+
+        self.decodeLegacyStrings(schema)
+
+    def decodeLegacyStrings(self, schema):
+        """
+        Replaces quote substitutes with quotes in scan names, root paths and fsobject full paths.
+        """
+        replace = "REPLACE(REPLACE({column}, ?, ''''), ?, '\"')"
+        match = "(instr({column}, ?) > 0 OR instr({column}, ?) > 0)"
+        markers = (self.LEGACY_SINGLE_QUOTE, self.LEGACY_DOUBLE_QUOTE)
+
+        if self.hasTable("scan", schema):
+            query = "UPDATE \"{schema}\".scan SET name = {name}, root_path = {rootPath} WHERE {nameMatch} OR {rootPathMatch}".format(
+                schema=schema, name=replace.format(column="name"), rootPath=replace.format(column="root_path"),
+                nameMatch=match.format(column="name"), rootPathMatch=match.format(column="root_path"))
+            self.execDelete(query, markers * 4, True)
+
+        if not self.hasColumn("fsobject", "full_path", schema):
+            return
+
+        query = "UPDATE \"{schema}\".fsobject SET full_path = {fullPath} WHERE {match} AND id BETWEEN ? AND ?".format(
+            schema=schema, fullPath=replace.format(column="full_path"), match=match.format(column="full_path"))
+        self.updateInBatches("Decoding legacy paths", schema,
+                             "fsobject", query, markers * 2)
+
+    def normalizePaths(self, schema):
+        """
+        Replaces full path of every fsobject row by its name, root folders keep their full path as name.
+        Names are filled in batches, then full_path column is dropped.
+        """
+        if not self.hasColumn("fsobject", "full_path", schema):
+            return
+
+        self.addColumnIfMissing("fsobject", "name", "TEXT", schema)
+
+        # Name starts after parent path and separator, root "/" already ends with separator.
+        query = "UPDATE \"{schema}\".fsobject SET name = CASE WHEN parent_id = 0 THEN full_path ELSE substr(full_path, " \
+            "(SELECT length(p.full_path) + CASE WHEN substr(p.full_path, -1) = '/' THEN 1 ELSE 2 END " \
+            "FROM \"{schema}\".fsobject p WHERE p.id = fsobject.parent_id)) END " \
+            "WHERE id BETWEEN ? AND ?"
+        self.updateInBatches("Normalizing paths", schema,
+                             "fsobject", query.format(schema=schema))
+
+        # Indexes of older versions, full path index blocks dropping the column.
+        for name in ("fsobject_scan_full_path", "fsobject_scan_parent"):
+            self.execDelete("DROP INDEX IF EXISTS \"{schema}\".\"{name}\"".format(
+                schema=schema, name=name), None, False)
+        self.execDelete(
+            "ALTER TABLE \"{schema}\".fsobject DROP COLUMN full_path".format(schema=schema), None, True)
+        self.clog.warning(
+            "Dropped fsobject.full_path, run VACUUM on the database to return freed pages to the file system")
+
+    def rankDuplicateGroups(self, schema):
+        """
+        Fills wasted bytes and representative path of duplicate groups written before version 3, first
+        member of a group is its representative. Indexes replaced by covering ones are dropped.
+        """
+        if not self.hasTable("dup_group", schema):
+            return
+
+        self.addColumnIfMissing("dup_group", "wasted_bytes", "INTEGER", schema)
+        self.addColumnIfMissing("dup_group", "representative_path", "TEXT", schema)
+        for name in ("dup_group_scan", "dup_group_member_group"):
+            self.execDelete("DROP INDEX IF EXISTS \"{schema}\".\"{name}\"".format(
+                schema=schema, name=name), None, False)
+
+        pending = self.fetchAll("SELECT COUNT(*) FROM \"{schema}\".dup_group WHERE wasted_bytes IS NULL".format(
+            schema=schema), None)[0][0]
+        if pending == 0:
+            return
+
+        # Path of the representative is built by walking up to the root, root name is the root path.
+        query = "WITH RECURSIVE up(group_id, parent_id, path) AS (" \
+            "SELECT g.id, f.parent_id, f.name FROM \"{schema}\".dup_group g JOIN \"{schema}\".fsobject f ON f.id = " \
+            "(SELECT MIN(m.fsobject_id) FROM \"{schema}\".dup_group_member m WHERE m.group_id = g.id) WHERE g.wasted_bytes IS NULL " \
+            "UNION ALL " \
+            "SELECT up.group_id, p.parent_id, CASE WHEN substr(p.name, -1) = '/' THEN p.name || up.path ELSE p.name || '/' || up.path END " \
+            "FROM up JOIN \"{schema}\".fsobject p ON p.id = up.parent_id" \
+            ") UPDATE \"{schema}\".dup_group SET wasted_bytes = size_in_bytes * (member_count - 1), representative_path = up.path " \
+            "FROM up WHERE up.group_id = dup_group.id AND up.parent_id = 0"
+        self.execDelete(query.format(schema=schema), None, True)
+        self.clog.warning(
+            "Ranked %d duplicate groups by wasted bytes", pending)
+
+    def storeBinaryHashes(self, schema):
+        """
+        Converts hex hashes of fsobject, dup_group and hash_cache to raw bytes and fills integer hash prefix of
+        fsobject, empty hash becomes NULL. Indexes on hashes are dropped first so batches do not maintain them,
+        createScanIndexes() builds the prefix index. Converted columns keep declared type TEXT, text affinity
+        stores blobs as they are.
+        """
+        hash = Hash()
+        self.conn.create_function(
+            "hex_to_hash", 1, lambda value: self.hexToHash(hash, value), deterministic=True)
+
+        if self.hasTable("fsobject", schema):
+            self.addColumnIfMissing("fsobject", "hash_prefix", "INTEGER", schema)
+            for name in ("fsobject_scan_content_hash", "fsobject_scan_type_state"):
+                self.execDelete("DROP INDEX IF EXISTS \"{schema}\".\"{name}\"".format(
+                    schema=schema, name=name), None, True)
+
+            query = "UPDATE \"{schema}\".fsobject SET content_hash = hex_to_hash(content_hash), partial_hash = hex_to_hash(partial_hash), " \
+                "hash_prefix = hash_to_prefix(hex_to_hash(content_hash)) WHERE id BETWEEN ? AND ?"
+            self.updateInBatches("Converting object hashes", schema,
+                                 "fsobject", query.format(schema=schema))
+
+        for table in ("dup_group", "hash_cache"):
+            if self.hasTable(table, schema):
+                query = "UPDATE \"{schema}\".\"{table}\" SET content_hash = hex_to_hash(content_hash) WHERE id BETWEEN ? AND ?"
+                self.updateInBatches("Converting {table} hashes".format(table=table), schema,
+                                     table, query.format(schema=schema, table=table))
+
+        self.clog.warning(
+            "Converted hashes of %s, run VACUUM on the database to return freed pages to the file system", schema)
+
+    def addSizeToPrefixIndex(self, schema):
+        """
+        Drops hash prefix index without size, createScanIndexes() builds fsobject_scan_type_state_prefix_size.
+        """
+        self.execDelete("DROP INDEX IF EXISTS \"{schema}\".fsobject_scan_type_state_prefix".format(
+            schema=schema), None, True)
+
+    def addScanFailureColumns(self, schema):
+        """
+        Adds columns that count failed attempts of a scan and hold the time of its next attempt.
+        """
+        if self.hasTable("scan", schema):
+            self.addColumnIfMissing("scan", "failure_count", "INTEGER DEFAULT 0", schema)
+            self.addColumnIfMissing("scan", "last_error", "TEXT", schema)
+            self.addColumnIfMissing("scan", "retry_timestamp", "INTEGER", schema)
+
+    def addAlgorithmHashColumn(self, schema):
+        """
+        Adds column that keeps hash of the scan algorithm of a file whose content hash was replaced by a confirm or
+        class hash. Such files of scans written before are not known, files of scans that confirm or verify
+        duplicates get an empty algorithm hash, incremental scans hash them again instead of reusing their hash.
+        """
+        if not self.hasTable("fsobject", schema):
+            return
+
+        self.addColumnIfMissing("fsobject", "algorithm_hash", "BLOB", schema)
+        # Files in states DUPLICATE_BY_HASH, UNIQUE_BY_HASH, DUPLICATE_BY_CONTENT and UNIQUE_BY_CONTENT of version 7.
+        query = "UPDATE \"{schema}\".fsobject SET algorithm_hash = X'' WHERE type = ? AND state IN (?, ?, ?, ?) " \
+            "AND scan_id IN (SELECT id FROM main.scan WHERE confirm_hash = 1 OR verify_content = 1) AND id BETWEEN ? AND ?"
+        self.updateInBatches("Marking replaced object hashes", schema,
+                             "fsobject", query.format(schema=schema), (2, 3, 6, 12, 13))
+
+    def hexToHash(self, hash, value):
+        """
+        :return: Hash written as hex text before version 4 as bytes. Suffix ":<n>" of a split class of identical
+        files becomes the derived class hash, see Hash.computeClassHash(). Bytes are returned as they are.
+        """
+        if not isinstance(value, str):
+            return value
+        if not value:
+            return None
+
+        contentHash, _, classNumber = value.partition(":")
+        if classNumber:
+            return hash.computeClassHash(bytes.fromhex(contentHash), int(classNumber))
+        return bytes.fromhex(contentHash)
+
+    def createFsobjectIndexes(self, names=None, schema=None):
+        """
+        Creates missing secondary indexes of fsobject table.
+        :param names: Names from FSOBJECT_INDEXES to create, None creates all.
+        :param schema: Database of the table, None is the scan set by useScan().
+        """
+        for name in (names or self.FSOBJECT_INDEXES):
+            query = "CREATE INDEX IF NOT EXISTS \"{schema}\".\"{name}\" ON fsobject({columns})".format(
+                schema=schema or self.scanSchema, name=name, columns=self.FSOBJECT_INDEXES[name])
+            self.execInsert(query, None, False)
+
+        self.commit()
+
+    def dropFsobjectIndexes(self):
+        """
+        Drops secondary indexes of fsobject table of the scan set by useScan() so bulk insert does not have to maintain them.
+        """
+        for name in self.FSOBJECT_INDEXES:
+            self.execDelete("DROP INDEX IF EXISTS \"{schema}\".\"{name}\"".format(
+                schema=self.scanSchema, name=name), None, False)
+
+        self.commit()
+
+    def hasOtherScanObjects(self, scanId):
+        """
+        Tells whether fsobject table of the scan set by useScan() holds objects of other scans. Indexes of such a table
+        are kept during bulk insert, rebuilding them would read objects of every stored scan and queries of the other
+        scans would scan the whole table meanwhile. A per scan file holds only its own scan.
+        """
+        if self.perScanFiles:
+            return False
+
+        query = "SELECT EXISTS (SELECT 1 FROM fsobject WHERE scan_id < ?) OR EXISTS (SELECT 1 FROM fsobject WHERE scan_id > ?)"
+        return bool(self.fetchAll(query, (scanId, scanId))[0][0])
+
+    def addColumnIfMissing(self, table, column, columnType, schema="main"):
+        """
+        Adds a column to an existing table, if table does not have it already.
+        :param table: Name of the table.
+        :param column: Name of the column to add.
+        :param columnType: Sqlite type of the column.
+        :param schema: Database of the table.
+        :return: True if column was added.
+        """
+        if self.hasColumn(table, column, schema):
+            return False
+
+        self.clog.warning("Adding column %s.%s", table, column)
+        query = "ALTER TABLE \"{schema}\".\"{table}\" ADD COLUMN \"{column}\" {columnType}".format(
+            schema=schema, table=table, column=column, columnType=columnType)
         self.execInsert(query, None, True)
+        return True
+
+    def hasColumn(self, table, column, schema="main"):
+        columns = [row[1] for row in self.fetchAll(
+            "PRAGMA \"{schema}\".table_info(\"{table}\")".format(schema=schema, table=table), None)]
+        return column in columns
+
+    def hasTable(self, table, schema="main"):
+        query = "SELECT 1 FROM \"{schema}\".sqlite_master WHERE type = 'table' AND name = ?".format(
+            schema=schema)
+        return len(self.fetchAll(query, (table, ))) > 0
 
     def execInsert(self, query, params, commit_immediately):
         """
@@ -60,47 +740,75 @@ class DB:
         :param commit_immediately: If True, query will be commit to DB after execution, if False, query will be executed without commit. Caller must ensure to call commit() function once done with all insertions.
         :return: Last inserted Id.
         """
-
-        self.clog.info("Executing insert query: {query} params: {params}".format(
-            query=query, params=params))
-
+        start = time.perf_counter()
         cur = self.conn.cursor()
         if params is not None:
             cur.execute(query, params)
         else:
             cur.execute(query)
+        self.record(query, time.perf_counter() - start, max(cur.rowcount, 0))
 
         if commit_immediately:
-            self.conn.commit()
+            self.commit()
 
         return cur.lastrowid
 
+    def execMany(self, query, rows, commit_immediately):
+        """
+        Execute a insert / update query once for every row using executemany.
+        :param query:  Sqlite query with ? placeholders.
+        :param rows: Collection of params tuples, one tuple per execution.
+        :param commit_immediately: If True, query will be commit to DB after execution, if False, query will be executed without commit. Caller must ensure to call commit() function once done with all insertions.
+        :return: Number of rows modified.
+        """
+        start = time.perf_counter()
+        cur = self.conn.cursor()
+        cur.executemany(query, rows)
+        self.record(query, time.perf_counter() - start, max(cur.rowcount, 0))
+
+        if commit_immediately:
+            self.commit()
+
+        return cur.rowcount
+
     def execDelete(self, query, params, commit_immediately):
         """
         Execute a delete query with filter params
         :param query:  Sqlite delete query.
         :param params: Params as a collection, if its None, then only query will be executed.
         :param commit_immediately: If True, query will be commit to DB after execution, if False, query will be executed without commit. Caller must ensure to call commit() function once done with all insertions.
-        :return: Nothing.
+        :return: Number of rows modified.
         """
-        self.clog.info("Executing delete query: {query} params: {params}".format(
-            query=query, params=params))
-
+        start = time.perf_counter()
         cur = self.conn.cursor()
         if params is not None:
             cur.execute(query, params)
         else:
             cur.execute(query)
+        self.record(query, time.perf_counter() - start, max(cur.rowcount, 0))
 
         if commit_immediately:
-            self.conn.commit()
+            self.commit()
+
+        return cur.rowcount
 
     def commit(self):
         """
         Commit the executed queries into database file.
         :return: Nothing.
         """
+        start = time.perf_counter()
         self.conn.commit()
+        self.record("COMMIT", time.perf_counter() - start, 0)
+
+    def rollback(self):
+        """
+        Discards the queries executed since last commit.
+        :return: Nothing.
+        """
+        start = time.perf_counter()
+        self.conn.rollback()
+        self.record("ROLLBACK", time.perf_counter() - start, 0)
 
     def fetchAll(self, query, params):
         """
@@ -108,13 +816,14 @@ class DB:
         If params is None, its is ignored.
         :return: Collection of tuple of rows matching query
         """
-        self.clog.info("Executing select query: {query}".format(query=query))
-
+        start = time.perf_counter()
         cur = self.conn.cursor()
         if params is not None:
             cur.execute(query, params)
         else:
             cur.execute(query)
 
-        return cur.fetchall()
+        rows = cur.fetchall()
+        self.record(query, time.perf_counter() - start, len(rows))
+        return rows
 
@@ -0,0 +1,128 @@
+import os
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Single directory entry as reported by the walker, all stat fields come from the same stat call.
+WalkEntry = namedtuple(
+    "WalkEntry", ["name", "sizeInBytes", "mtimeNs", "inode", "device"])
+
+# Class walks a directory tree top-down using os.scandir, it reuses the DirEntry data
+# so every file is stat'ed only once. Directories can optionally be listed by a pool of
+# threads, the walk order stays the same as the serial walk.
+
+
+class Walker:
+    # Number of folder listings queued per worker thread ahead of the consumer.
+    PREFETCH_PER_WORKER = 32
+
+    def __init__(self, workers=1):
+        # Create logger
+        self.clog = logging.getLogger("CORE.WALKER")
+
+        # Number of threads used to list directories, 1 means serial walk.
+        self.workers = max(1, workers)
+
+    def statRoot(self, rootPath):
+        """
+        Function returns a WalkEntry for the root path itself, its name is the full root path.
+        """
+        st = os.stat(rootPath)
+        return WalkEntry(rootPath, -1, st.st_mtime_ns, st.st_ino, st.st_dev)
+
+    def listDir(self, parent):
+        """
+        Function lists a single directory.
+        :return: Tuple (folders, files, subDirs), folders and files are list of WalkEntry and subDirs is
+        list of full path of folders that should be walked next (symbolic links are not followed).
+        Entries that are neither folder nor regular file are skipped.
+        """
+        folders = []
+        files = []
+        subDirs = []
+        try:
+            with os.scandir(parent) as it:
+                for entry in it:
+                    try:
+                        isDir = entry.is_dir()
+                        isFile = entry.is_file()
+                        st = entry.stat()
+                    except OSError as ex:
+                        # Broken symbolic links or files removed during the walk.
+                        self.clog.warning(
+                            "Skipping unreadable entry: %s (%s)", entry.path, ex)
+                        continue
+
+                    if isDir:
+                        folders.append(WalkEntry(
+                            entry.name, -1, st.st_mtime_ns, st.st_ino, st.st_dev))
+                        if not entry.is_symlink():
+                            subDirs.append(entry.path)
+                    elif isFile:
+                        files.append(WalkEntry(
+                            entry.name, st.st_size, st.st_mtime_ns, st.st_ino, st.st_dev))
+                    else:
+                        # FIFOs, sockets and device nodes have no content to compare, opening a FIFO blocks.
+                        self.clog.warning(
+                            "Skipping entry that is not a regular file: %s", entry.path)
+        except OSError as ex:
+            # Same as os.walk, directories that can not be listed are skipped.
+            self.clog.warning("Skipping unreadable folder: %s (%s)", parent, ex)
+
+        return folders, files, subDirs
+
+    def walk(self, rootPath):
+        """
+        Generator walks the tree top-down in the same order as os.walk.
+        :return: Yields tuple (parent, folders, files) for each folder.
+        """
+        if self.workers > 1:
+            return self.walkParallel(rootPath)
+
+        return self.walkSerial(rootPath)
+
+    def walkSerial(self, rootPath):
+        stack = [rootPath]
+        while stack:
+            parent = stack.pop()
+            folders, files, subDirs = self.listDir(parent)
+            yield parent, folders, files
+
+            # Push in reverse so sub folders are visited in listing order.
+            stack.extend(reversed(subDirs))
+
+    def walkParallel(self, rootPath):
+        """
+        Same walk as walkSerial, but folders are listed ahead of time by a thread pool.
+        Results are still yielded in the serial order from the calling thread, so a single
+        writer sees every parent before its children.
+        """
+        maxPending = self.workers * self.PREFETCH_PER_WORKER
+        pool = ThreadPoolExecutor(max_workers=self.workers,
+                                  thread_name_prefix="walker")
+        try:
+            # Stack items are [path, future], future is None when the listing is not queued yet.
+            stack = [[rootPath, pool.submit(self.listDir, rootPath)]]
+            pending = 1
+            while stack:
+                parent, future = stack.pop()
+                if future is None:
+                    folders, files, subDirs = self.listDir(parent)
+                else:
+                    folders, files, subDirs = future.result()
+                    pending -= 1
+
+                # Queue sub folders in listing order while prefetch window has room.
+                items = []
+                for subDir in subDirs:
+                    if pending < maxPending:
+                        items.append([subDir, pool.submit(self.listDir, subDir)])
+                        pending += 1
+                    else:
+                        items.append([subDir, None])
+
+                yield parent, folders, files
+
+                stack.extend(reversed(items))
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
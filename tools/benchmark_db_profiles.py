@@ -0,0 +1,124 @@
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+
+from core.sqlite_db import DB
+from core.fsobject import FsObject
+
+# Benchmark compares ingest and query speed of the database tuning profiles.
+# Usage: python -m tools.benchmark_db_profiles [folders] [files per folder]
+# A synthetic tree is inserted through FsObject into a fresh database per profile, then the folder
+# size pass and small committed updates are timed on it. Database is opened again with the read-only
+# UI profile to time size grouping and point lookups by parent and name. "default" is SQLite without any pragma.
+
+# Number of (parent, name) lookups timed per database.
+LOOKUPS = 10000
+
+# Number of single row updates timed with a commit each, as scan state changes and hash batches do.
+COMMITS = 2000
+
+
+class DefaultDB(DB):
+    """
+    Database connection with SQLite defaults, rollback journal and synchronous FULL.
+    """
+
+    def applyProfile(self, profile):
+        self.profile = "default"
+
+
+def ingest(fsobject, folders, filesPerFolder):
+    random.seed(1)
+    fsobject.insert(FsObject.FSOBJECT_TYPE_FOLDER,
+                    None, "/bench", -1, 0, 1, 1)
+    objects = []
+    for d in range(folders):
+        parentId = fsobject.insert(FsObject.FSOBJECT_TYPE_FOLDER, "/bench",
+                                   "d{d}".format(d=d), -1, 0, 2 + d, 1)
+        parent = "/bench/d{d}".format(d=d)
+        for f in range(filesPerFolder):
+            name = "f{f}.bin".format(f=f)
+            fsobject.insert(FsObject.FSOBJECT_TYPE_FILE, parent, name,
+                            random.randint(0, 1 << 20), 0, 0, 1)
+            objects.append((parentId, name))
+
+    fsobject.flushInserts()
+    return objects
+
+
+def query(db, objects):
+    """
+    :return: Tuple (seconds of size grouping, seconds per path lookup).
+    """
+    start = time.perf_counter()
+    db.fetchAll("SELECT size_in_bytes, COUNT(*) FROM fsobject WHERE scan_id = ? AND type = ? GROUP BY size_in_bytes HAVING COUNT(*) > 1",
+                (1, FsObject.FSOBJECT_TYPE_FILE))
+    groupSeconds = time.perf_counter() - start
+
+    sample = random.sample(objects, min(LOOKUPS, len(objects)))
+    start = time.perf_counter()
+    for parentId, name in sample:
+        db.fetchAll(
+            "SELECT id FROM fsobject WHERE scan_id = ? AND parent_id = ? AND name = ?", (1, parentId, name))
+    return groupSeconds, (time.perf_counter() - start) / len(sample)
+
+
+def run(profile, folders, filesPerFolder):
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="findup_bench_") as folder:
+        os.chdir(folder)
+        try:
+            db = DefaultDB() if profile is None else DB(profile)
+            db.createDbs()
+            fsobject = FsObject(db)
+            fsobject.setScanId(1)
+
+            db.dropFsobjectIndexes()
+            start = time.perf_counter()
+            objects = ingest(fsobject, folders, filesPerFolder)
+            db.createFsobjectIndexes()
+            ingestSeconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            fsobject.updateFolderSize()
+            folderSizeSeconds = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for i in range(COMMITS):
+                db.execDelete("UPDATE fsobject SET state = ? WHERE id = ?",
+                              (FsObject.FSOBJECT_STATE_PENDING, i + 1), True)
+            commitSeconds = (time.perf_counter() - start) / COMMITS
+
+            groupSeconds, lookupSeconds = query(db, objects)
+            db.conn.close()
+
+            uiDb = DB(DB.PROFILE_READ_ONLY_UI)
+            uiGroupSeconds, uiLookupSeconds = query(uiDb, objects)
+            uiDb.conn.close()
+        finally:
+            os.chdir(cwd)
+
+    rows = len(objects) + folders + 1
+    print("{profile:>13}: ingest {ingestRate:8.0f} rows/sec  folder size {folderSize:5.2f}s  commit {commit:6.1f} us  "
+          "grouping {group:5.2f}s  lookup {lookup:5.1f} us  |  read-only-ui grouping {uiGroup:5.2f}s  lookup {uiLookup:5.1f} us".format(
+              profile=profile or "default", ingestRate=rows / ingestSeconds, folderSize=folderSizeSeconds, commit=commitSeconds * 1000000,
+              group=groupSeconds, lookup=lookupSeconds * 1000000, uiGroup=uiGroupSeconds, uiLookup=uiLookupSeconds * 1000000))
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    folders = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    filesPerFolder = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    print("{rows} rows per database".format(
+        rows=folders * (filesPerFolder + 1) + 1))
+
+    # Read-only UI profile rejects writes, it is timed on database written by every other profile.
+    for profile in (None, DB.PROFILE_SAFE, DB.PROFILE_BULK_INGEST):
+        run(profile, folders, filesPerFolder)
+
+
+if __name__ == "__main__":
+    main()
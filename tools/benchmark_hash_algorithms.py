@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import tempfile
+
+from core.hash import Hash, xxhash
+from core.walker import Walker
+
+# Benchmark compares throughput of the supported hash algorithms.
+# Usage: python -m tools.benchmark_hash_algorithms [folder] [max files]
+# With a folder, files found under it are hashed so the result reflects that file size
+# distribution. Without a folder, a synthetic mix of small and large files is created.
+
+# Synthetic file size mix as (size in bytes, count).
+SYNTHETIC_SIZES = [(4 * 1024, 2000), (256 * 1024, 200),
+                   (8 * 1024 * 1024, 20), (128 * 1024 * 1024, 2)]
+
+
+def collectFiles(folder, maxFiles):
+    paths = []
+    for parent, folders, files in Walker().walk(folder):
+        for f in files:
+            paths.append(os.path.join(parent, f.name))
+            if len(paths) >= maxFiles:
+                return paths
+
+    return paths
+
+
+def createFiles(folder):
+    paths = []
+    block = os.urandom(1024 * 1024)
+    for sizeInBytes, count in SYNTHETIC_SIZES:
+        for i in range(count):
+            path = os.path.join(folder, "bench_{size}_{i}.bin".format(
+                size=sizeInBytes, i=i))
+            with open(path, "wb") as f:
+                written = 0
+                while written < sizeInBytes:
+                    f.write(block[:sizeInBytes - written])
+                    written += len(block)
+            paths.append(path)
+
+    return paths
+
+
+def measure(algorithm, paths):
+    hash = Hash(algorithm=algorithm)
+    totalBytes = 0
+    start = time.perf_counter()
+    for path in paths:
+        try:
+            hash.computeFileHash(path)
+            totalBytes += os.path.getsize(path)
+        except OSError:
+            pass
+
+    elapsed = time.perf_counter() - start
+    return totalBytes, elapsed
+
+
+def run(paths):
+    for algorithm in Hash.ALGORITHMS:
+        if algorithm == Hash.ALGORITHM_XXH64 and xxhash is None:
+            print("{algorithm:>8}: skipped, xxhash package is not installed".format(
+                algorithm=algorithm))
+            continue
+
+        totalBytes, elapsed = measure(algorithm, paths)
+        print("{algorithm:>8}: {files} files {size:.1f} MB in {elapsed:.2f}s  {rate:8.1f} MB/s".format(
+            algorithm=algorithm, files=len(paths), size=totalBytes / (1024 * 1024), elapsed=elapsed,
+            rate=totalBytes / elapsed / (1024 * 1024) if elapsed else 0))
+
+
+def main():
+    if len(sys.argv) > 1:
+        maxFiles = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+        run(collectFiles(sys.argv[1], maxFiles))
+        return
+
+    with tempfile.TemporaryDirectory(prefix="findup_bench_") as folder:
+        run(createFiles(folder))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import hashlib
+import tempfile
+
+from core.hash import Hash
+
+# Benchmark compares the old 4 KB f.read hashing loop with readinto and mmap hashing of Hash.
+# Usage: python -m tools.benchmark_hash_read [max size in MB] [block size in KB] [folder]
+# Files from 1 KB up to max size (default 1024 MB, use 10240 for 10 GB) are created in a
+# temporary folder and removed at the end.
+
+
+def hashWithReadLoop(filePath):
+    sha256Hash = hashlib.sha256()
+    with open(filePath, "rb") as f:
+        for byteBlock in iter(lambda: f.read(4096), b""):
+            sha256Hash.update(byteBlock)
+
+        return sha256Hash.digest()
+
+
+def createFile(folder, sizeInBytes):
+    path = os.path.join(folder, "bench_{size}.bin".format(size=sizeInBytes))
+    block = os.urandom(min(sizeInBytes, 1024 * 1024))
+    with open(path, "wb") as f:
+        written = 0
+        while written < sizeInBytes:
+            f.write(block[:sizeInBytes - written])
+            written += len(block)
+
+    return path
+
+
+def measure(func, path, sizeInBytes):
+    # Repeat small files so timing is not dominated by timer resolution.
+    rounds = max(1, (64 * 1024 * 1024) // sizeInBytes) if sizeInBytes < 64 * 1024 * 1024 else 1
+    rounds = min(rounds, 10000)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        result = func(path)
+    elapsed = (time.perf_counter() - start) / rounds
+
+    return result, sizeInBytes / elapsed / (1024 * 1024)
+
+
+def main():
+    maxSizeMb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    blockSizeKb = int(sys.argv[2]) if len(sys.argv) > 2 else Hash.BLOCK_SIZE // 1024
+    folder = sys.argv[3] if len(sys.argv) > 3 else None
+
+    readinto = Hash(blockSizeKb * 1024, None)
+    mmapHash = Hash(blockSizeKb * 1024, 1)
+
+    print("{size:>12} {old:>14} {readinto:>14} {mmap:>14}".format(
+        size="size", old="f.read 4K", readinto="readinto", mmap="mmap"))
+    with tempfile.TemporaryDirectory(prefix="findup_bench_", dir=folder) as tmp:
+        sizeInBytes = 1024
+        while sizeInBytes <= maxSizeMb * 1024 * 1024:
+            path = createFile(tmp, sizeInBytes)
+            oldHash, oldRate = measure(hashWithReadLoop, path, sizeInBytes)
+            newHash, newRate = measure(readinto.computeFileHash, path, sizeInBytes)
+            mmapResult, mmapRate = measure(mmapHash.computeFileHash, path, sizeInBytes)
+            if not oldHash == newHash == mmapResult:
+                print("ERROR: hash mismatch for {size} bytes".format(size=sizeInBytes))
+                sys.exit(1)
+
+            print("{size:>12} {old:>9.1f} MB/s {new:>9.1f} MB/s {mm:>9.1f} MB/s".format(
+                size=sizeInBytes, old=oldRate, new=newRate, mm=mmapRate))
+            os.remove(path)
+            sizeInBytes *= 16
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+
+from core.sqlite_db import DB
+from core.hash import Hash
+from core.fsobject import FsObject
+
+# Benchmark compares hex text content hashes with raw bytes and an integer hash prefix.
+# Usage: python -m tools.benchmark_hash_storage [files] [duplicate ratio]
+# The same files with sha256 sized hashes, a share of them copies of earlier files, are written into a
+# fresh database per layout with the hash indexes of that layout. Size of the fsobject table and its hash
+# index is reported from dbstat, grouping time is the hash grouping that marks duplicate files, run on
+# files in HASH_COMPUTED state as markDuplicateFiles() does.
+
+# Hash indexes of the layouts before hashes were stored as bytes, the prefix layout uses FSOBJECT_INDEXES.
+LEGACY_INDEXES = {
+    "fsobject_scan_type_state": "scan_id, type, state",
+    "fsobject_scan_content_hash": "scan_id, content_hash"
+}
+
+# Grouping of the layouts without prefix.
+LEGACY_GROUP_QUERY = "SELECT content_hash FROM fsobject WHERE scan_id = ? AND type = ? AND state IN (?, ?) GROUP BY content_hash HAVING COUNT(*) > 1"
+
+# Grouping of the prefix layout, see FsObject.markSharedHashes().
+PREFIX_GROUP_QUERY = "SELECT hash_prefix, size_in_bytes FROM fsobject WHERE scan_id = ? AND type = ? AND state IN (?, ?) " \
+    "GROUP BY hash_prefix, size_in_bytes HAVING COUNT(*) > 1"
+
+# Only columns read by the grouping are filled.
+INSERT_QUERY = "INSERT INTO fsobject(id, scan_id, parent_id, type, name, state, size_in_bytes, content_hash, hash_prefix) " \
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# Layouts, name to (hash as hex text, integer prefix column).
+LAYOUTS = [("hex text", True, False), ("bytes", False, False), ("bytes + prefix", False, True)]
+
+
+def createRows(files, duplicateRatio, hexText, withPrefix):
+    random.seed(1)
+    hash = Hash()
+    hashes = []
+    rows = []
+    for objectId in range(1, files + 1):
+        if hashes and random.random() < duplicateRatio:
+            contentHash = hashes[random.randrange(len(hashes))]
+        else:
+            contentHash = random.getrandbits(256).to_bytes(32, "big")
+        hashes.append(contentHash)
+
+        rows.append((objectId, 1, 0, FsObject.FSOBJECT_TYPE_FILE, "f{id}".format(id=objectId), FsObject.FSOBJECT_STATE_HASH_COMPUTED,
+                     1000, contentHash.hex() if hexText else contentHash, hash.getPrefix(contentHash) if withPrefix else None))
+    return rows
+
+
+def measure(files, duplicateRatio, hexText, withPrefix):
+    """
+    :return: Tuple (dictionary of table or index name to bytes, seconds of grouping, number of shared hashes).
+    """
+    rows = createRows(files, duplicateRatio, hexText, withPrefix)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="findup_bench_") as folder:
+        os.chdir(folder)
+        try:
+            db = DB(DB.PROFILE_BULK_INGEST)
+            db.createDbs()
+            db.dropFsobjectIndexes()
+            db.execMany(INSERT_QUERY, rows, True)
+            if withPrefix:
+                db.createFsobjectIndexes(["fsobject_scan_type_state_prefix_size"])
+                query = PREFIX_GROUP_QUERY
+            else:
+                for name, columns in LEGACY_INDEXES.items():
+                    db.execInsert("CREATE INDEX \"{name}\" ON fsobject({columns})".format(
+                        name=name, columns=columns), None, True)
+                query = LEGACY_GROUP_QUERY
+
+            sizes = dict(db.fetchAll("SELECT name, SUM(pgsize) FROM dbstat WHERE name = 'fsobject' OR name IN "
+                                     "(SELECT name FROM sqlite_master WHERE tbl_name = 'fsobject' AND type = 'index') GROUP BY name", None))
+
+            start = time.perf_counter()
+            groups = db.fetchAll(query, (1, FsObject.FSOBJECT_TYPE_FILE, FsObject.FSOBJECT_STATE_HASH_COMPUTED,
+                                         FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH))
+            groupSeconds = time.perf_counter() - start
+            db.conn.close()
+        finally:
+            os.chdir(cwd)
+
+    return sizes, groupSeconds, len(groups)
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    duplicateRatio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.3
+
+    for layout, hexText, withPrefix in LAYOUTS:
+        sizes, groupSeconds, groups = measure(
+            files, duplicateRatio, hexText, withPrefix)
+        hashIndexes = {name: size for name, size in sizes.items() if name != "fsobject"}
+        print("{layout}: table {table:.1f} MiB, hash indexes {indexes:.1f} MiB ({names}), "
+              "grouping {seconds:.2f}s, {groups} shared hashes".format(layout=layout, table=sizes["fsobject"] / 1048576,
+                                                                        indexes=sum(hashIndexes.values()) / 1048576, names=", ".join(sorted(hashIndexes)),
+                                                                        seconds=groupSeconds, groups=groups))
+
+
+if __name__ == "__main__":
+    main()
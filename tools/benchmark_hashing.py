@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from core.hash import Hash
+from core.hash_engine import HashEngine
+
+# Benchmark measures hashing throughput of HashEngine with increasing number of workers.
+# Usage: python -m tools.benchmark_hashing [file count] [file size in MB] [max workers] [folder]
+# Files are created in a temporary folder (or given folder) and removed at the end. Drop the
+# page cache between runs to measure storage instead of memory bandwidth.
+
+
+def createFiles(folder, fileCount, fileSize):
+    paths = []
+    block = os.urandom(1024 * 1024)
+    for i in range(fileCount):
+        path = os.path.join(folder, "bench_{i}.bin".format(i=i))
+        with open(path, "wb") as f:
+            written = 0
+            while written < fileSize:
+                f.write(block[:min(len(block), fileSize - written)])
+                written += len(block)
+        paths.append(path)
+
+    return paths
+
+
+def measure(paths, workers):
+    hash = Hash()
+    engine = HashEngine(workers)
+    start = time.perf_counter()
+    totalBytes = 0
+    for path, _ in engine.run(paths, hash.computeFileHash):
+        totalBytes += os.path.getsize(path)
+
+    return totalBytes, time.perf_counter() - start
+
+
+def main():
+    fileCount = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    fileSizeMb = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    maxWorkers = int(sys.argv[3]) if len(sys.argv) > 3 else os.cpu_count()
+    folder = tempfile.mkdtemp(
+        prefix="findup_bench_", dir=sys.argv[4] if len(sys.argv) > 4 else None)
+
+    try:
+        paths = createFiles(folder, fileCount, fileSizeMb * 1024 * 1024)
+        workers = 1
+        baseline = None
+        while workers <= maxWorkers:
+            totalBytes, elapsed = measure(paths, workers)
+            rate = totalBytes / elapsed / (1024 * 1024)
+            baseline = baseline or rate
+            print("workers: {w:3d}  {rate:10.1f} MB/s  speedup: {s:5.2f}x".format(
+                w=workers, rate=rate, s=rate / baseline))
+            workers *= 2
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import random
+import logging
+import tempfile
+
+from core.sqlite_db import DB
+from core.fsobject import FsObject
+
+# Benchmark compares database size of the old full path per row layout with name plus parent id.
+# Usage: python -m tools.benchmark_path_storage [files] [files per folder] [folder fan-out]
+# The same synthetic deep tree of a completed scan, with content hashes filled in, is written into
+# a fresh database per layout with the indexes of that layout. Size of the fsobject table and its
+# indexes is reported from dbstat, it is also the page cache needed to keep all of them resident.
+# Numbers are extrapolated linearly to 10M files, both layouts grow linearly with number of rows.
+
+# Number of files the numbers are extrapolated to.
+TARGET_FILES = 10000000
+
+# Root of the synthetic tree, a typical home folder location.
+ROOT_PATH = "/home/findup/data/archive"
+
+# Indexes of the full path layout, before paths were normalized. Hash index is the current one so
+# only path storage differs.
+LEGACY_INDEXES = {
+    "fsobject_scan_parent": "scan_id, parent_id",
+    "fsobject_scan_full_path": "scan_id, name",
+    "fsobject_scan_type_size": "scan_id, type, size_in_bytes",
+    "fsobject_scan_type_state_prefix_size": "scan_id, type, state, hash_prefix, size_in_bytes"
+}
+
+
+def createRows(files, filesPerFolder, fanOut, fullPath):
+    """
+    Creates rows of a tree whose folders are filled breadth first, every folder holds filesPerFolder
+    files and fanOut sub folders, so depth grows with number of files.
+    :param fullPath: If True name column holds full path as the old layout did.
+    """
+    random.seed(1)
+    rows = []
+    timestamp = int(round(time.time() * 1000))
+
+    def addRow(parentId, objectType, name, path, sizeInBytes, contentHash):
+        objectId = len(rows) + 1
+        rows.append((objectId, 1, parentId, objectType, path if fullPath else name, FsObject.FSOBJECT_STATE_UNIQUE_BY_SIZE,
+                     sizeInBytes, contentHash, timestamp, timestamp, timestamp * 1000000, objectId, 1, None))
+        return objectId
+
+    folders = [(addRow(0, FsObject.FSOBJECT_TYPE_FOLDER,
+                       ROOT_PATH, ROOT_PATH, 0, None), ROOT_PATH)]
+    fileCount = 0
+    index = 0
+    while fileCount < files:
+        folderId, folderPath = folders[index]
+        index += 1
+        for f in range(min(filesPerFolder, files - fileCount)):
+            name = "document_{f:05d}.dat".format(f=f)
+            addRow(folderId, FsObject.FSOBJECT_TYPE_FILE, name, os.path.join(folderPath, name),
+                   random.randint(0, 1 << 30), random.getrandbits(256).to_bytes(32, "big"))
+            fileCount += 1
+
+        for d in range(fanOut):
+            name = "folder_{d:03d}".format(d=d)
+            path = os.path.join(folderPath, name)
+            folders.append((addRow(folderId, FsObject.FSOBJECT_TYPE_FOLDER,
+                                   name, path, 0, None), path))
+
+    depth = folders[index - 1][1].count(os.sep) - ROOT_PATH.count(os.sep)
+    return rows, depth
+
+
+def measure(files, filesPerFolder, fanOut, fullPath):
+    """
+    :return: Tuple (rows, depth, bytes per object, dictionary of table or index name to bytes, seconds to read all file paths).
+    """
+    rows, depth = createRows(files, filesPerFolder, fanOut, fullPath)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="findup_bench_") as folder:
+        os.chdir(folder)
+        try:
+            db = DB(DB.PROFILE_BULK_INGEST)
+            db.createDbs()
+            db.dropFsobjectIndexes()
+            db.execMany(FsObject.INSERT_QUERY, rows, True)
+            if fullPath:
+                for name, columns in LEGACY_INDEXES.items():
+                    db.execInsert("CREATE INDEX \"{name}\" ON fsobject({columns})".format(
+                        name=name, columns=columns), None, True)
+            else:
+                db.createFsobjectIndexes()
+
+            sizes = dict(db.fetchAll("SELECT name, SUM(pgsize) FROM dbstat WHERE name = 'fsobject' OR name IN "
+                                     "(SELECT name FROM sqlite_master WHERE tbl_name = 'fsobject' AND type = 'index') GROUP BY name", None))
+
+            # Full path of every file, as the hashing stages need them.
+            start = time.perf_counter()
+            if fullPath:
+                db.fetchAll("SELECT id, name, device, inode, size_in_bytes, mtime_ns FROM fsobject WHERE scan_id = ? AND type = ? AND state = ?",
+                            (1, FsObject.FSOBJECT_TYPE_FILE, FsObject.FSOBJECT_STATE_UNIQUE_BY_SIZE))
+            else:
+                fsobject = FsObject(db)
+                fsobject.setScanId(1)
+                fsobject.getFiles(FsObject.FSOBJECT_STATE_UNIQUE_BY_SIZE)
+            pathSeconds = time.perf_counter() - start
+            db.conn.close()
+        finally:
+            os.chdir(cwd)
+
+    return len(rows), depth, sum(sizes.values()) / len(rows), sizes, pathSeconds
+
+
+def main():
+    logging.disable(logging.CRITICAL)
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    filesPerFolder = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    fanOut = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+    results = {}
+    for layout, fullPath in (("full path", True), ("name", False)):
+        rowCount, depth, bytesPerRow, sizes, pathSeconds = measure(
+            files, filesPerFolder, fanOut, fullPath)
+        results[layout] = bytesPerRow
+        scale = TARGET_FILES / files
+        print("{layout}: {rows} rows, {depth} folders deep, {total:.1f} MiB, {perRow:.0f} bytes per row, "
+              "all file paths read in {seconds:.2f}s".format(layout=layout, rows=rowCount, depth=depth,
+                                                            total=sum(sizes.values()) / 1048576, perRow=bytesPerRow, seconds=pathSeconds))
+        for name, size in sorted(sizes.items(), key=lambda item: -item[1]):
+            print("    {name:28} {size:9.1f} MiB, {target:9.1f} MiB at {files}M files".format(
+                name=name, size=size / 1048576, target=size * scale / 1048576, files=TARGET_FILES // 1000000))
+        print("    {name:28} {size:9.1f} MiB, {target:9.1f} MiB at {files}M files".format(
+            name="total", size=sum(sizes.values()) / 1048576, target=sum(sizes.values()) * scale / 1048576, files=TARGET_FILES // 1000000))
+
+    print("name layout needs {ratio:.0%} of full path layout".format(
+        ratio=results["name"] / results["full path"]))
+
+
+if __name__ == "__main__":
+    main()
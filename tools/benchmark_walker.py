@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import logging
+
+from core.walker import Walker
+
+# Benchmark compares the old os.walk + os.path.getsize walk with the scandir based Walker.
+# Usage: python -m tools.benchmark_walker <root path> [rounds] [workers ...]
+
+
+def walkWithOsWalk(rootPath):
+    totalFolders = 0
+    totalFiles = 0
+    totalSizeInBytes = 0
+    for parent, dirs_list, files_list in os.walk(rootPath):
+        totalFolders += len(dirs_list)
+        for f in files_list:
+            totalFiles += 1
+            try:
+                totalSizeInBytes += os.path.getsize(os.path.join(parent, f))
+            except OSError:
+                # Walker skips broken links, count them the same way here.
+                totalFiles -= 1
+
+    return totalFolders, totalFiles, totalSizeInBytes
+
+
+def walkWithWalker(rootPath, workers=1):
+    totalFolders = 0
+    totalFiles = 0
+    totalSizeInBytes = 0
+    for parent, folders, files in Walker(workers).walk(rootPath):
+        totalFolders += len(folders)
+        totalFiles += len(files)
+        for f in files:
+            totalSizeInBytes += f.sizeInBytes
+
+    return totalFolders, totalFiles, totalSizeInBytes
+
+
+def walkOrder(rootPath, workers):
+    return [(parent, [d.name for d in folders], [f.name for f in files])
+            for parent, folders, files in Walker(workers).walk(rootPath)]
+
+
+def measure(name, func, rootPath, rounds):
+    best = None
+    result = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = func(rootPath)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print("{name:>12}: {best:8.3f}s  folders: {folders} files: {files} bytes: {size}  ({rate:,.0f} files/sec)".format(
+        name=name, best=best, folders=result[0], files=result[1], size=result[2], rate=result[1] / best if best else 0))
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python -m tools.benchmark_walker <root path> [rounds] [workers ...]")
+        sys.exit(1)
+
+    rootPath = sys.argv[1]
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    workersList = [int(w) for w in sys.argv[3:]] or [4, 16]
+
+    # Skipped entries are expected on live trees, keep the output readable.
+    logging.getLogger("CORE").setLevel(logging.ERROR)
+
+    measure("os.walk", walkWithOsWalk, rootPath, rounds)
+    measure("scandir", walkWithWalker, rootPath, rounds)
+
+    serialOrder = walkOrder(rootPath, 1)
+    for workers in workersList:
+        measure("scandir x{w}".format(w=workers),
+                lambda path: walkWithWalker(path, workers), rootPath, rounds)
+        if walkOrder(rootPath, workers) != serialOrder:
+            print("ERROR: parallel walk with {w} workers differs from serial walk".format(w=workers))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
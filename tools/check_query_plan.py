@@ -0,0 +1,149 @@
+import os
+import re
+import sys
+import logging
+import tempfile
+
+from core.sqlite_db import DB
+from core.scan import Scan
+from core.hash import Hash
+from core.duplicate_group import DuplicateGroup
+
+# Developer check that every query issued by the scan pipeline and the web UI is served by an
+# index. A complete scan and an incremental rescan are run on a synthetic tree inside a temporary
+# folder while all statements are traced, then EXPLAIN QUERY PLAN is run for every distinct
+# statement. Exits with status 1 if any of them scans a whole fsobject family table.
+# Usage: python -m tools.check_query_plan [-v] [--per-scan-files]
+# --per-scan-files runs the same check on a database that stores every scan in its own file.
+
+# Tables that grow with number of scanned objects, a full scan of them is a failure.
+CHECKED_TABLES = ("fsobject", "dup_group", "dup_group_member")
+
+# Statements that are not queries.
+SKIPPED_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA", "CREATE", "DROP", "ALTER", "ANALYZE", "EXPLAIN")
+
+# Words that can follow a table name but are not an alias.
+KEYWORDS = {"WHERE", "SET", "JOIN", "ON", "GROUP", "ORDER", "LIMIT", "LEFT", "INNER", "VALUES"}
+
+
+def createTree(root):
+    """
+    Creates a tree that takes every stage of the pipeline: unique sizes, equal sizes with different
+    content, equal head and tail with different middle, duplicate files and duplicate folders.
+    """
+    sample = 200 * 1024
+    for folder in ("a/x", "a/y", "b/x", "b/y", "c"):
+        os.makedirs(os.path.join(root, folder), exist_ok=True)
+
+    files = {
+        "a/x/same.txt": b"same content",
+        "b/x/same.txt": b"same content",
+        "a/y/big.bin": b"h" * sample + b"1" + b"t" * sample,
+        "b/y/big.bin": b"h" * sample + b"1" + b"t" * sample,
+        "c/other.bin": b"h" * sample + b"2" + b"t" * sample,
+        "c/size1.txt": b"aaaa",
+        "c/size2.txt": b"bbbb",
+        "c/unique.txt": b"unique size"
+    }
+    for path, content in files.items():
+        with open(os.path.join(root, path), "wb") as f:
+            f.write(content)
+
+
+def normalize(statement):
+    """
+    Replaces literal values so statements that differ only in bound values are checked once.
+    """
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\b\d+\b", "?", statement)
+    return " ".join(statement.split())
+
+
+def getAliases(statement):
+    """
+    :return: Set of names under which checked tables appear in the plan of the statement.
+    """
+    aliases = set()
+    pattern = r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(?:\"?\w+\"?\.)?\"?({tables})\"?(?:\s+(?:AS\s+)?(\w+))?".format(
+        tables="|".join(CHECKED_TABLES))
+    for table, alias in re.findall(pattern, statement, re.IGNORECASE):
+        aliases.add(table)
+        if alias and alias.upper() not in KEYWORDS:
+            aliases.add(alias)
+
+    return aliases
+
+
+def runPipeline(statements):
+    scan = Scan()
+    scan.db.conn.set_trace_callback(
+        lambda statement: statements.setdefault(normalize(statement), statement))
+
+    # Small folder map forces parent lookups through the database.
+    scan.fsobject.maxCachedFolders = 1
+
+    root = os.path.abspath("tree")
+    createTree(root)
+    for incremental in (False, True):
+        scan.insert("check", root, incremental, Hash.ALGORITHM_CRC32, True, True)
+        scan.process()
+
+    # Queries of the web UI duplicate report, first page and a page after it.
+    scan.db.useScan(1, False)
+    duplicateGroup = DuplicateGroup(scan.db)
+    groups = duplicateGroup.getGroups(1, 50)
+    for group in groups:
+        duplicateGroup.getMembers(group[0])
+    duplicateGroup.getGroups(1, 50, (groups[0][5], groups[0][0]))
+
+    scan.db.conn.set_trace_callback(None)
+
+    # Statements of incremental rescan refer to both scans, unqualified names resolve to the rescan.
+    scan.db.useScan(2)
+    scan.db.attachScan(1)
+    return scan.db
+
+
+def main():
+    verbose = "-v" in sys.argv[1:]
+    perScanFiles = "--per-scan-files" in sys.argv[1:]
+    if not verbose:
+        logging.disable(logging.CRITICAL)
+
+    failures = 0
+    statements = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="findup_plan_") as folder:
+        os.chdir(folder)
+        try:
+            DB().createDbs(perScanFiles)
+            db = runPipeline(statements)
+
+            for statement in statements.values():
+                if statement.lstrip().upper().startswith(SKIPPED_STATEMENTS):
+                    continue
+
+                aliases = getAliases(statement)
+                plan = [row[3] for row in db.fetchAll(
+                    "EXPLAIN QUERY PLAN " + statement, None)]
+                fullScans = [detail for detail in plan
+                             if detail.startswith("SCAN ") and detail.split()[1] in aliases]
+                if fullScans:
+                    failures += 1
+                    print("FULL SCAN: {statement}".format(statement=statement))
+                    for detail in plan:
+                        print("    {detail}".format(detail=detail))
+                elif verbose:
+                    print("ok: {statement}".format(statement=statement))
+                    for detail in plan:
+                        print("    {detail}".format(detail=detail))
+        finally:
+            os.chdir(cwd)
+
+    print("{count} distinct statements checked, {failures} with full table scan{layout}".format(
+        count=len(statements), failures=failures, layout=" (per scan files)" if perScanFiles else ""))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
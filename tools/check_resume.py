@@ -0,0 +1,231 @@
+import os
+import sys
+import logging
+import tempfile
+
+from core.sqlite_db import DB
+from core.scan import Scan
+from core.fsobject import FsObject
+
+# Developer check that an interrupted or disturbed scan gives the same result as an undisturbed one.
+# Every scenario runs a scan on its own tree inside a temporary folder, interrupts or disturbs it at
+# a chosen point, resumes it with a new Scan object as a restarted core server would, then compares
+# file states.
+# Exits with status 1 if any scenario ends with different states.
+# Usage: python -m tools.check_resume [-v]
+
+
+class Crash(BaseException):
+    """
+    Stands for the process being killed, it is not an Exception so nothing in the pipeline handles it.
+    """
+
+
+def writeFiles(root, files):
+    for path, content in files.items():
+        fullPath = os.path.join(root, path)
+        os.makedirs(os.path.dirname(fullPath), exist_ok=True)
+        with open(fullPath, "wb") as f:
+            f.write(content)
+
+
+def getStates(db, scanId):
+    """
+    :return: Dictionary of file name to state.
+    """
+    db.useScan(scanId, False)
+    return dict(db.fetchAll("SELECT name, state FROM fsobject WHERE scan_id = ? AND type = ?",
+                            (scanId, FsObject.FSOBJECT_TYPE_FILE)))
+
+
+def crashAfterFullHashes(scan, count):
+    """
+    Makes full content hashing crash after count files, every hash is committed on its own.
+    """
+    scan.fsobject.UPDATE_BATCH_SIZE = 1
+    computeFileHash = scan.fsobject.hash.computeFileHash
+    calls = []
+
+    def crashingComputeFileHash(filePath):
+        if len(calls) == count:
+            raise Crash()
+        calls.append(filePath)
+        return computeFileHash(filePath)
+
+    scan.fsobject.hash.computeFileHash = crashingComputeFileHash
+
+
+def stopAfterFullHashes(scan, count):
+    """
+    Requests stop of the scan once count files got their full hash.
+    """
+    computeFileHash = scan.fsobject.hash.computeFileHash
+    calls = []
+
+    def stoppingComputeFileHash(filePath):
+        calls.append(filePath)
+        if len(calls) == count:
+            scan.requestStop()
+        return computeFileHash(filePath)
+
+    scan.fsobject.hash.computeFileHash = stoppingComputeFileHash
+
+
+def checkFullHashResume(root):
+    """
+    Twins larger than two partial hash samples, crash after the first of them got its full hash.
+    """
+    content = b"h" * FsObject.PARTIAL_HASH_SAMPLE_BYTES * 2 + b"m" * 40000
+    writeFiles(root, {"a.bin": content, "b.bin": content})
+
+    scan = Scan()
+    scanId = scan.insert("resume", root)
+    crashAfterFullHashes(scan, 1)
+    try:
+        scan.process()
+    except Crash:
+        pass
+
+    Scan().process()
+
+    expected = {"a.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                "b.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH}
+    return expected, getStates(scan.db, scanId)
+
+
+def checkStopResume(root):
+    """
+    Twins larger than two partial hash samples, stop requested while the first of them gets its full hash.
+    The scan keeps its hashing state and the resumed scan completes it.
+    """
+    content = b"h" * FsObject.PARTIAL_HASH_SAMPLE_BYTES * 2 + b"s" * 40000
+    writeFiles(root, {"a.bin": content, "b.bin": content})
+
+    scan = Scan()
+    scanId = scan.insert("resume", root)
+    stopAfterFullHashes(scan, 1)
+    scan.process()
+    state = scan.db.fetchAll("SELECT state FROM scan WHERE id = ?", (scanId, ))[0][0]
+    if state != Scan.SCAN_STATE_SCANNED:
+        return {"scan state": Scan.SCAN_STATE_SCANNED}, {"scan state": state}
+
+    Scan().process()
+
+    expected = {"a.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                "b.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH}
+    return expected, getStates(scan.db, scanId)
+
+
+def checkRemovedFile(root):
+    """
+    One of three identical files is removed after the walk, it is skipped and the other two are duplicates.
+    """
+    content = b"r" * 50000
+    writeFiles(root, {"a.bin": content, "b.bin": content, "c.bin": content})
+
+    scan = Scan()
+    scanId = scan.insert("resume", root)
+    flushInserts = scan.fsobject.flushInserts
+
+    def removingFlushInserts():
+        flushInserts()
+        if os.path.exists(os.path.join(root, "c.bin")):
+            os.remove(os.path.join(root, "c.bin"))
+
+    scan.fsobject.flushInserts = removingFlushInserts
+    scan.process()
+
+    expected = {"a.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                "b.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                "c.bin": FsObject.FSOBJECT_STATE_UNREADABLE}
+    return expected, getStates(scan.db, scanId)
+
+
+def checkFailedScan(root):
+    """
+    Scan of a missing root fails and is backed off, the scan added after it still completes. Once the root
+    exists, a retried scan completes without waiting for its back off.
+    """
+    content = b"f" * 50000
+    writeFiles(root, {"a.bin": content, "b.bin": content})
+
+    scan = Scan()
+    failedId = scan.insert("failing", os.path.join(root, "missing"))
+    scanId = scan.insert("resume", root)
+    scan.process()
+
+    failures = scan.db.fetchAll("SELECT failure_count FROM scan WHERE id = ?", (failedId, ))[0][0]
+    if failures != 1:
+        return {"failure count": 1}, {"failure count": failures}
+
+    os.makedirs(os.path.join(root, "missing"))
+    scan.retry(failedId)
+    scan.process()
+    state = scan.db.fetchAll("SELECT state FROM scan WHERE id = ?", (failedId, ))[0][0]
+    if state != Scan.SCAN_STATE_COMPLETED:
+        return {"retried scan state": Scan.SCAN_STATE_COMPLETED}, {"retried scan state": state}
+
+    expected = {"a.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                "b.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH}
+    return expected, getStates(scan.db, scanId)
+
+
+def checkConfirmedRescan(root):
+    """
+    Files confirmed as duplicates by a crc32 scan, an identical file added before an incremental rescan is
+    a duplicate of them too.
+    """
+    content = b"c" * 50000
+    writeFiles(root, {"one.bin": content, "two.bin": content})
+    Scan().insert("resume", root, hashAlgorithm="crc32", confirmHash=True)
+    Scan().process()
+
+    writeFiles(root, {"three.bin": content})
+    scan = Scan()
+    scanId = scan.insert("resume", root, incremental=True, hashAlgorithm="crc32", confirmHash=True)
+    scan.process()
+
+    expected = {"one.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                "two.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH,
+                "three.bin": FsObject.FSOBJECT_STATE_DUPLICATE_BY_HASH}
+    return expected, getStates(scan.db, scanId)
+
+
+# Scenarios, name to function taking an empty root folder and returning (expected, actual) states.
+SCENARIOS = [("crash during full hash", checkFullHashResume),
+             ("stop during full hash", checkStopResume),
+             ("file removed after walk", checkRemovedFile),
+             ("failing scan does not block the next", checkFailedScan),
+             ("incremental rescan of confirmed duplicates", checkConfirmedRescan)]
+
+
+def main():
+    verbose = "-v" in sys.argv[1:]
+    if not verbose:
+        logging.disable(logging.CRITICAL)
+
+    failures = 0
+    cwd = os.getcwd()
+    for name, scenario in SCENARIOS:
+        with tempfile.TemporaryDirectory(prefix="findup_resume_") as folder:
+            os.chdir(folder)
+            try:
+                DB().createDbs()
+                expected, actual = scenario(os.path.join(folder, "tree"))
+            finally:
+                os.chdir(cwd)
+
+        if expected != actual:
+            failures += 1
+            print("FAILED: {name}, expected {expected}, got {actual}".format(
+                name=name, expected=expected, actual=actual))
+        elif verbose:
+            print("ok: {name}".format(name=name))
+
+    print("{count} resume scenarios checked, {failures} failed".format(
+        count=len(SCENARIOS), failures=failures))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -50,6 +50,24 @@ class WebUIHelper:
     def getReadableNumber(self, n):
         return locale.format("%d", n, grouping=True)
 
+    def getReadableHash(self, contentHash):
+        """ Returns hex string of a hash stored as bytes"""
+        return contentHash.hex() if contentHash else ""
+
+    def parseGroupCursor(self, value):
+        """
+        Parses "<wasted bytes>:<group id>" cursor of duplicate report page.
+        :return: Tuple (wasted_bytes, id), None for missing or malformed cursor so first page is shown.
+        """
+        parts = (value or "").split(":")
+        if len(parts) != 2:
+            return None
+
+        try:
+            return int(parts[0]), int(parts[1])
+        except ValueError:
+            return None
+
     def getNewScanForm(self, scanName="", message=None):
         htmlForm = '''
     <form id="formNewScan" name="formNewScan" action="/scan/new" method="POST" enctype="multipart/form-data">
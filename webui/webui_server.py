@@ -1,11 +1,17 @@
 import os
+import html
 from bottle import get, post, request, run
 from core.sqlite_db import DB
 from core.scan import Scan
+from core.fsobject import FsObject
+from core.duplicate_group import DuplicateGroup
 from webui.webui_helper import WebUIHelper
 
 webuiHelper = WebUIHelper()
 
+# Duplicate groups shown per page.
+GROUPS_PER_PAGE = 50
+
 
 @get('/')
 def scan_list():
@@ -14,8 +20,8 @@ def scan_list():
     It returns top 50 scans in descending order of their time i.e., latest scan comes on top.
     It displays information like scan name, path, state, created time, total folders and files.
     """
-    scan = Scan()
-    db = DB()
+    scan = Scan(dbProfile=DB.PROFILE_READ_ONLY_UI)
+    db = DB(DB.PROFILE_READ_ONLY_UI)
     query = """SELECT id, name, root_path, state, folder_count, file_count, total_size_in_bytes,
   created_timestamp FROM scan ORDER BY created_timestamp DESC"""
     scans = db.fetchAll(query, None)
@@ -30,6 +36,7 @@ def scan_list():
         <td>File Count</td>
         <td>Total Size</td>
         <td>Created</td>
+        <td>Duplicates</td>
       </tr>
   '''
     for s in scans:
@@ -43,14 +50,72 @@ def scan_list():
       <td>{fileCount}</td>
       <td>{totalSize}</td>
       <td>{createdDateTime}</td>
+      <td><a href="/scan/{scanId}/duplicates">View</a></td>
     </tr>
-    """.format(scanId=s[0], name=s[1], rootPath=s[2], state=scan.getReadableState(s[3]), folderCount=webuiHelper.getReadableNumber(s[4]),
+    """.format(scanId=s[0], name=html.escape(s[1]), rootPath=html.escape(s[2]), state=scan.getReadableState(s[3]), folderCount=webuiHelper.getReadableNumber(s[4]),
                fileCount=webuiHelper.getReadableNumber(s[5]), totalSize=webuiHelper.getReadableObjectSize(s[6]), createdDateTime=webuiHelper.getReadableTimestamp(s[7]))
     response += "</table>"
 
     return webuiHelper.getHTMLPage(response)
 
 
+@get('/scan/<scanId:int>/duplicates')
+def scan_duplicates(scanId):
+    """
+    Function that serves duplicate report of a scan, one page of topmost duplicate groups with largest
+    wasted space first. Objects inside a duplicate folder are not listed, they belong to the group of that folder.
+    Next page starts after the last group of this page, given as "<wasted bytes>:<group id>" in query,
+    malformed value shows the first page.
+    """
+    after = webuiHelper.parseGroupCursor(request.query.get("after"))
+    db = DB(DB.PROFILE_READ_ONLY_UI)
+    duplicateGroup = DuplicateGroup(db)
+    groups = []
+    # Scan without its own file yet, pending in per scan layout, has an empty report.
+    if db.hasScanFile(scanId):
+        db.useScan(scanId, False)
+        groups = duplicateGroup.getGroups(scanId, GROUPS_PER_PAGE, after)
+
+    response = '''
+    <table cellspacing="5" cellpadding="5" border="1">
+      <tr>
+        <td>Type</td>
+        <td>Size</td>
+        <td>Copies</td>
+        <td>Wasted</td>
+        <td>Representative</td>
+        <td>Hash</td>
+        <td>Paths</td>
+      </tr>
+  '''
+    for g in groups:
+        # Names come from scanned storage and may contain markup.
+        paths = "<br/>".join(html.escape(m[1]) for m in duplicateGroup.getMembers(g[0]))
+        response += """
+    <tr>
+      <td>{type}</td>
+      <td>{size}</td>
+      <td>{count}</td>
+      <td>{wasted}</td>
+      <td>{representative}</td>
+      <td>{hash}</td>
+      <td>{paths}</td>
+    </tr>
+    """.format(type="Folder" if g[2] == FsObject.FSOBJECT_TYPE_FOLDER else "File", size=webuiHelper.getReadableObjectSize(g[3]),
+               count=webuiHelper.getReadableNumber(g[4]), wasted=webuiHelper.getReadableObjectSize(g[5]), representative=html.escape(g[6]),
+               hash=webuiHelper.getReadableHash(g[1]), paths=paths)
+    response += "</table>"
+
+    if after is not None:
+        response += '<a href="/scan/{scanId}/duplicates">First</a> '.format(
+            scanId=scanId)
+    if len(groups) == GROUPS_PER_PAGE:
+        response += '<a href="/scan/{scanId}/duplicates?after={wasted}:{groupId}">Next</a>'.format(
+            scanId=scanId, wasted=groups[-1][5], groupId=groups[-1][0])
+
+    return webuiHelper.getHTMLPage(response)
+
+
 @get('/scan/new')
 def scan_new_get():
     """